@@ -39,11 +39,16 @@
 #    statement from all source files in the program, then also delete it here.
 #
 import os
+import binascii
 from deluge.plugins.pluginbase import CorePluginBase
 import deluge.component as component
 import deluge.configmanager
 from deluge.core.rpcserver import export
 from deluge import bencode
+from twisted.internet import defer
+from twisted.internet import threads
+from twisted.internet import task
+from twisted.internet import reactor
 import time
 
 import logging
@@ -66,6 +71,70 @@ DEFAULT_PREFS = {
                   #  add_new_metafile function below. That way, only files
                   #  that are NEWLY added will be run through, and not files
                   #  that were previously added some time ago.
+    "verificationThreads": 1,  # Number of threads reading and hashing
+                               #  pieces of potential matches at once.
+    "verificationMemoryLimit": 64*1024*1024,  # Upper bound in bytes on the
+                                              #  piece data held in memory
+                                              #  by the hashing threads.
+    "fastVerification": True,  # Check one piece of each file, rather than
+                               #  every piece of every potential match.
+    "sequentialReads": True,  # In thorough verification, read each
+                              #  potential match once, from start to end,
+                              #  rather than a piece at a time.
+    "candidateReader": "buffered",  # How potential matches are read:
+                                    #  "buffered" suits any storage,
+                                    #  "mmap" libraries in the page cache
+                                    #  or on SSDs, not being written to,
+                                    #  since truncating a file while it is
+                                    #  read crashes Deluge, and "direct"
+                                    #  large libraries on spinning disks,
+                                    #  read around the page cache.
+    "dropReadsFromPageCache": True,  # Drop what is read from potential
+                                     #  matches from the page cache once
+                                     #  hashed, so that matching does not
+                                     #  push out the pieces being seeded.
+    "rotationalReadConcurrency": 1,  # Number of potential matches read
+                                     #  at once from each spinning disk.
+    "solidStateReadConcurrency": 4,  # Number of potential matches read
+                                     #  at once from each other device.
+    "readBandwidthPerDevice": 0,  # MiB/s read from potential matches on
+                                  #  each device, so that the disks being
+                                  #  seeded from are never saturated. 0
+                                  #  does not limit reads.
+    "skipRecheck": False,  # When all files are positively matched, and
+                           #  every piece was hashed from them in thorough
+                           #  verification, hand the pieces to libtorrent
+                           #  as resume data instead of forcing a full
+                           #  recheck.
+    "recheckSampleSize": 16,  # Number of verified pieces hashed again,
+                              #  chosen at random, before a recheck is
+                              #  skipped.
+    "maxConcurrentRelinks": 1,  # Number of torrents being matched at once,
+                                #  off of the reactor thread.
+    "watchContentDirectories": False,  # Apply changes to the content
+                                       #  directories to the cache as they
+                                       #  happen, using inotify on Linux.
+    "cacheReconcileInterval": 60*60,  # Seconds between refreshes of the
+                                      #  cache, which only list the
+                                      #  directories that changed, and
+                                      #  catch any change the watcher
+                                      #  missed. 0 disables refreshes.
+    "cacheBackend": "memory",  # Either "memory", to keep the cache in
+                               #  memory and copy it to disk as it changes,
+                               #  or "disk", to query the cache on disk.
+                               #  Takes effect when the plugin is enabled.
+    "scanThreadsPerDevice": 2,  # Number of threads listing the content
+                                #  directories stored on each disk. Every
+                                #  disk is walked at the same time.
+    "hardLinkPreference": "shortest",  # Which of the paths to a file linked
+                                       #  into several places is given as its
+                                       #  potential match. One of "shortest",
+                                       #  "alphabetical", or
+                                       #  "contentDirectoryOrder".
+    "headIndexBandwidth": 0,  # MiB/s read in the background to index the
+                              #  first piece of every library file, so that
+                              #  single-file torrents are matched by one
+                              #  lookup. 0 disables the index.
 }
 
 # Default Actions are as follows:
@@ -81,22 +150,67 @@ LOCALBFF_CACHE_FILE = os.path.join(
     LOCALBFF_CACHE_FILENAME
 )
 
+# Hashes of previously checked pieces are kept beside the content cache.
+LOCALBFF_HASH_CACHE_FILENAME = "localbff_hashes.db"
+LOCALBFF_HASH_CACHE_FILE = os.path.join(
+    deluge.configmanager.get_config_dir(),
+    LOCALBFF_HASH_CACHE_FILENAME
+)
+
+# The head hash index is built in batches of files, starting a while after
+#  the plugin is enabled, and is brought up to date once in a while.
+HEAD_INDEX_BATCH_SIZE = 256
+HEAD_INDEX_START_DELAY = 60
+HEAD_INDEX_PASS_INTERVAL = 60*60
+
 from localbff import metafile
 from localbff.localbff import LocalBitTorrentFileFinder
-def match(fastVerification, metafileDict, potentialMatches):
+def get_finder(fastVerification, metafileDict, potentialMatches, hashCache=None,
+               numberOfThreads=1, memoryLimit=64*1024*1024, statCache=None,
+               sequentialReads=False, reader="buffered", dropReadRanges=False,
+               ioScheduler=None):
   current_metafile = metafile.getMetafileFromDict(metafileDict)
-  finder = LocalBitTorrentFileFinder(current_metafile, fastVerification)
+  finder = LocalBitTorrentFileFinder(
+    current_metafile,
+    fastVerification,
+    hashCache,
+    numberOfThreads=numberOfThreads,
+    memoryLimit=memoryLimit,
+    statCache=statCache,
+    sequentialReads=sequentialReads,
+    reader=reader,
+    dropReadRanges=dropReadRanges,
+    ioScheduler=ioScheduler
+  )
   
   i = 0
   for f in potentialMatches:
     finder.connectPayloadFileToPotentialMatches(i, f)
     i += 1
 
-  finder.positivelyMatchFilesInMetafileToPossibleMatches()
   return finder
 
 
+def are_all_files_positively_matched(finder):
+  for f in finder.files:
+    if f.status != "MATCH_FOUND" and not f.isPadFile:
+      return False
+  return True
+
+
+def get_pad_file_indices(info):
+  # Pad files are never looked for on disk, and never written.
+  return set(i for i, f in enumerate(info.get('files', [])) if utils.isPadFile(f))
+
+
 from localbff import cache
+from localbff import hashcache
+from localbff import utils
+from localbff.statcache import StatCache
+from localbff.headindexer import HeadHashIndexer
+from localbff.ioscheduler import IOScheduler
+from relinkqueue import RelinkQueue
+from watcher import ContentDirectoryWatcher
 class Core(CorePluginBase):
     def enable(self):
         log.info('LocalBFF enabled.')
@@ -106,9 +220,62 @@ class Core(CorePluginBase):
         )
         self.cache = cache.load(
             dirs=self.config['contentDirectories'],
-            persistent_path=LOCALBFF_CACHE_FILE
+            persistent_path=LOCALBFF_CACHE_FILE,
+            backend=self.config['cacheBackend'],
+            scanThreadsPerDevice=self.config['scanThreadsPerDevice']
+        )
+        self.hash_cache = hashcache.load(
+            persistent_path=LOCALBFF_HASH_CACHE_FILE
+        )
+        # Whether possible matches can be read, shared by the relinks
+        #  running at once.
+        self.stat_cache = StatCache()
+        # Reads of possible matches take turns on each device, across the
+        #  relinks running at once.
+        self.io_scheduler = IOScheduler(
+            self.config['rotationalReadConcurrency'],
+            self.config['solidStateReadConcurrency'],
+            self.config['readBandwidthPerDevice']*1024*1024
         )
 
+        # Newly added library content is picked up without a rescan when
+        #  the content directories are watched.
+        self.watcher = ContentDirectoryWatcher(self.cache)
+        if self.config['watchContentDirectories']:
+            self.watcher.start(self.config['contentDirectories'])
+
+        self.cache_update_running = None
+        self.reconcile_task = None
+        if self.config['cacheReconcileInterval']:
+            self.reconcile_task = task.LoopingCall(self.update_cache)
+            self.reconcile_task.start(self.config['cacheReconcileInterval'], now=False)
+
+        # Torrents that this plugin removes and adds again with resume data
+        #  must not be relinked a second time when they are added.
+        self.readded_torrents = set()
+
+        # Matching is done in threads, off of the reactor, for a limited
+        #  number of torrents at a time.
+        self.relink_queue = RelinkQueue(
+            self.run_relink_job,
+            self.config['maxConcurrentRelinks']
+        )
+
+        self.head_indexer = None
+        self.head_index_call = None
+        self.head_index_running = None
+        self.head_index_position = None
+        if self.config['headIndexBandwidth']:
+            self.head_indexer = HeadHashIndexer(
+                self.hash_cache,
+                self.config['headIndexBandwidth']*1024*1024,
+                self.config['dropReadsFromPageCache']
+            )
+            self.head_index_call = reactor.callLater(
+                HEAD_INDEX_START_DELAY,
+                self.index_head_hashes
+            )
+
         # When a new metafile is added to Deluge's queue, execute the
         #  add_new_metafile(id) function of this plugin.
         component.get("EventManager").register_event_handler(
@@ -124,6 +291,26 @@ class Core(CorePluginBase):
             "TorrentAddedEvent",
             self.add_new_metafile
         )
+        relinks_finished = self.relink_queue.cancel_all()
+        if self.reconcile_task is not None:
+            self.reconcile_task.stop()
+        self.watcher.stop()
+        if self.head_indexer is not None:
+            self.head_indexer.stop()
+        if self.head_index_call is not None and self.head_index_call.active():
+            self.head_index_call.cancel()
+
+        # Cancelled relinks, and the head indexer, stop at the next piece
+        #  or file. The hash cache is only closed once their threads, and
+        #  that of a cache update pruning it, are done with it.
+        stopped = [relinks_finished]
+        if self.head_index_running is not None:
+            stopped.append(self.head_index_running)
+        if self.cache_update_running is not None:
+            stopped.append(self.cache_update_running)
+        d = defer.DeferredList(stopped)
+        d.addCallback(lambda ignored: self.hash_cache.close())
+        return d
 
 
     def update(self):
@@ -138,6 +325,13 @@ class Core(CorePluginBase):
             log.debug("config['{0}'] = {1}".format(key, config[key]))
             self.config[key] = config[key]
         self.config.save()
+        self.relink_queue.set_max_running_jobs(self.config['maxConcurrentRelinks'])
+        self.cache.scanThreadsPerDevice = self.config['scanThreadsPerDevice']
+        self.io_scheduler.setLimits(
+            self.config['rotationalReadConcurrency'],
+            self.config['solidStateReadConcurrency'],
+            self.config['readBandwidthPerDevice']*1024*1024
+        )
 
 
     @export
@@ -155,6 +349,7 @@ class Core(CorePluginBase):
 
           # Load the files in the new content directory into the cache
           self.cache.addDirectory(directory)
+          self.watcher.watch(directory)
           self.config.save()
 
 
@@ -164,6 +359,7 @@ class Core(CorePluginBase):
         log.info("Content directory removed: {0}".format(dir_to_remove))
         if dir_to_remove in self.config['contentDirectories']:
           self.config['contentDirectories'].remove(dir_to_remove)
+          self.watcher.unwatch(dir_to_remove)
           self.cache.removeDirectory(dir_to_remove)
           self.config.save()
 
@@ -175,8 +371,10 @@ class Core(CorePluginBase):
         try:
           i = self.config['contentDirectories'].index(old_dir)
           self.config['contentDirectories'][i] = new_dir
+          self.watcher.unwatch(old_dir)
           self.cache.removeDirectory(old_dir)
           self.cache.addDirectory(new_dir)
+          self.watcher.watch(new_dir)
           self.config.save()
         except:
           import sys
@@ -204,9 +402,38 @@ class Core(CorePluginBase):
 
     @export
     def update_cache(self):
+        # The content directories are listed in a thread, so that the
+        #  reactor is free while a refresh, or the first full walk of a
+        #  cache built before directory states were kept, is running. A
+        #  refresh asked for while another is running is skipped.
+        if self.cache_update_running is not None:
+            log.info("Cache update already running, skipped")
+            return
         log.info("Cache updating...")
-        self.cache.refresh(dirs=self.config['contentDirectories'])
-        log.info("Cache update complete")
+        self.cache_update_running = defer.Deferred()
+        d = threads.deferToThread(
+            self.refresh_caches,
+            list(self.config['contentDirectories'])
+        )
+        d.addCallback(lambda ignored: log.info("Cache update complete"))
+        d.addErrback(lambda failure: log.error(
+            "Cache update failed:\n{0}".format(failure.getTraceback())
+        ))
+        d.addBoth(self.cache_update_done)
+        return d
+
+
+    def refresh_caches(self, dirs):
+        # Called in a thread. The hashes of the files that are gone from the
+        #  content directories, or have changed, are pruned once the cache
+        #  of the content directories is up to date.
+        self.cache.refresh(dirs)
+        self.hash_cache.prune(self.cache.getKnownFiles)
+
+
+    def cache_update_done(self, ignored):
+        running, self.cache_update_running = self.cache_update_running, None
+        running.callback(None)
 
 
     def add_new_metafile(self, torrent_id):
@@ -215,6 +442,11 @@ class Core(CorePluginBase):
         now = time.time()
         log.debug("New metafile added: {0} at {1}".format(torrent_id, now))
 
+        if torrent_id in self.readded_torrents:
+            log.debug("Metafile ID# {0} was re-added by LocalBFF.".format(torrent_id))
+            self.readded_torrents.discard(torrent_id)
+            return
+
         torrent_manager = component.get("Core").torrentmanager
         current_torrent = torrent_manager.torrents[torrent_id]
         time_added = current_torrent.get_status(['time_added'])['time_added']
@@ -246,15 +478,18 @@ class Core(CorePluginBase):
             ))
 
         else:
-            # Iterate through the files of the current metafile, and query
-            #  the cache for potential matches.
+            # Query the cache for the potential matches of the files of the
+            #  current metafile. They are handed on to the relink, so that
+            #  the cache is only queried once.
+            pad_file_indices = get_pad_file_indices(
+                bencode.bdecode(current_torrent.torrent_info.metadata())
+            )
+            potential_matches = self.get_potential_matches(
+                current_torrent.get_files(), pad_file_indices
+            )
             some_files_have_no_potential_matches = False
-            for f in current_torrent.get_files():
-                # Potential matches to a payload file are those files on
-                #  the hard drive that are the same size.
-                potential_matches = self.cache.getAllFilesOfSize(f['size'])
-                num_pot_matches = len(potential_matches)
-                if num_pot_matches == 0:
+            for i, file_potential_matches in enumerate(potential_matches):
+                if len(file_potential_matches) == 0 and i not in pad_file_indices:
                     some_files_have_no_potential_matches = True
 
             if some_files_have_no_potential_matches:
@@ -265,7 +500,7 @@ class Core(CorePluginBase):
                     #  there are any positive matches, they will be
                     #  relinked, and the missing ones will be downloaded.
                     log.info('Default action set to Download, so attempting relink')
-                    self.relink(torrent_id)
+                    self.relink_queue.add(torrent_id, potential_matches=potential_matches)
 
                 elif self.config['defaultAction'] == 1:
                     log.info('Default action set to Deleted, so removing')
@@ -279,7 +514,7 @@ class Core(CorePluginBase):
                 # If all of the files have potential matches, then we should
                 #  automatically attempt to relink.
                 log.info('All files have potential matches! Attemping a relink.')
-                self.relink(torrent_id)
+                self.relink_queue.add(torrent_id, potential_matches=potential_matches)
 
 
     @export
@@ -289,52 +524,232 @@ class Core(CorePluginBase):
         # Grab the torrent from the torrent manager
         current_torrent = component.get("Core").torrentmanager.torrents[torrent_id]
 
-        # Iterate through the payload files of the current torrent, and
-        #  query the cache for potential matches.
+        # Query the cache for the potential matches of the payload files of
+        #  the current torrent.
+        files = current_torrent.get_files()
+        pad_file_indices = get_pad_file_indices(
+            bencode.bdecode(current_torrent.torrent_info.metadata())
+        )
+        potential_matches = self.get_potential_matches(files, pad_file_indices)
         potential_match_data = {}
-        for f in current_torrent.get_files():
-            potential_matches = self.cache.getAllFilesOfSize(f['size'])
-            potential_match_data[f['path']] = len(potential_matches)
+        for f in files:
+            if f['index'] not in pad_file_indices:
+                potential_match_data[f['path']] = len(potential_matches[f['index']])
 
         # Return the number of potential matches for each payload file.
         return potential_match_data
 
 
+    def get_potential_matches(self, files, pad_file_indices=()):
+        # Potential matches to a payload file are those files on the hard
+        #  drive that are the same size. Every distinct size is looked up
+        #  in one query. Returns the potential matches of each file, by the
+        #  index of the file. Pad files have none, and their sizes are not
+        #  looked up.
+        preferred_path_key = cache.getPreferredPathKey(
+            self.config['hardLinkPreference'],
+            self.config['contentDirectories']
+        )
+        files_of_sizes = self.cache.getAllFilesOfSizes(
+            set(f['size'] for f in files if f['index'] not in pad_file_indices),
+            preferred_path_key
+        )
+        potential_matches = [[] for f in files]
+        for f in files:
+            if f['index'] not in pad_file_indices:
+                potential_matches[f['index']] = list(files_of_sizes[f['size']])
+        return potential_matches
+
+
+    def index_head_hashes(self):
+        # Hands the next batch of files in the cache to the head indexer,
+        #  in a thread, and continues with the following batch once done.
+        self.head_index_call = None
+        files = self.cache.getFilesAfter(self.head_index_position, HEAD_INDEX_BATCH_SIZE)
+        if not files:
+            # Every file has been indexed. The files added since are
+            #  indexed by the next pass.
+            log.debug("Head index is up to date")
+            self.head_index_position = None
+            self.head_index_call = reactor.callLater(
+                HEAD_INDEX_PASS_INTERVAL,
+                self.index_head_hashes
+            )
+            return
+
+        self.head_index_position = files[-1][0]
+        d = threads.deferToThread(
+            self.head_indexer.indexFiles,
+            [(path, size) for position, path, size in files]
+        )
+        d.addErrback(lambda failure: log.error(
+            "Indexing head hashes failed:\n{0}".format(failure.getTraceback())
+        ))
+        d.addCallback(self.continue_head_index)
+        self.head_index_running = defer.Deferred()
+
+
+    def continue_head_index(self, ignored):
+        running, self.head_index_running = self.head_index_running, None
+        running.callback(None)
+        if not self.head_indexer.isStopped:
+            self.head_index_call = reactor.callLater(0, self.index_head_hashes)
+
+
+    def prefer_indexed_head_match(self, info, files, potential_matches):
+        # The first piece of a metafile is the beginning of its first file
+        #  alone, if the metafile has only one file, or if the first file is
+        #  at least a piece long. A potential match of the first file whose
+        #  beginning has that hash, as found in the hash cache, and which has
+        #  not changed since, is tried first. The other potential matches are
+        #  kept, since files of the same size often share their beginning,
+        #  such as a header or zeros, and only the rest tells them apart.
+        if 'pieces' not in info or not potential_matches[0]:
+            return
+        first_file_size = files[0]['size']
+        piece_length = info['piece length']
+        if len(files) > 1 and first_file_size < piece_length:
+            return
+
+        head_length = min(piece_length, first_file_size)
+        identities = self.hash_cache.findIdentities(info['pieces'][:20], 0, head_length)
+        for identity in identities:
+            device, inode, size, mtime = identity
+            if size != first_file_size:
+                continue
+            for path in self.cache.getPathsOfFile(size, device, inode):
+                if path not in potential_matches[0]:
+                    continue
+                try:
+                    if hashcache.getFileIdentity(path) != identity:
+                        continue
+                except OSError:
+                    continue
+                log.info("Beginning of {0} found in the head index".format(path))
+                potential_matches[0] = [path] + [
+                    p for p in potential_matches[0] if p != path
+                ]
+                return
+
+
+    @export
+    def get_io_stats(self):
+        """Returns, for each device that possible matches were read from,
+        the reads queued and running on it, its limits, and what was read
+        from it"""
+        return self.io_scheduler.getStats()
+
+
+    @export
+    def relink(self, torrent_id, priority=0):
+        """Queue this torrent ID to be relinked to a positive match if one exists"""
+        self.relink_queue.add(torrent_id, priority)
+
+
+    @export
+    def get_relink_queue(self):
+        """Returns the running and queued relink jobs, in the order they
+        will be started"""
+        return self.relink_queue.get_jobs()
+
+
     @export
-    def relink(self, torrent_id):
-        """Relink this torrent ID to a positive match if one exists"""
+    def set_relink_priority(self, torrent_id, priority):
+        """Change the priority of a queued relink job. Jobs with a higher
+        priority are started first."""
+        return self.relink_queue.set_priority(torrent_id, priority)
+
+
+    @export
+    def cancel_relink(self, torrent_id):
+        """Remove a queued relink job, or stop a running one"""
+        return self.relink_queue.cancel(torrent_id)
+
+
+    def run_relink_job(self, job):
         # 1. Find the potential matches for this file.
         #     If no matches are found, perform the default action.
         # Grab the torrent from the torrent manager
+        torrent_id = job.torrent_id
         log.info("Relinking torrent {0}".format(torrent_id))
         torrent_manager = component.get("Core").torrentmanager
         current_torrent = torrent_manager.torrents[torrent_id]
 
-        # Get the filenames and file sizes of each payload file
+        # Query the cache for the potential matches of each payload file,
+        #  unless that was done when the torrent was added.
+        potential_matches = job.potential_matches
+        job.potential_matches = None
         files = current_torrent.get_files()
-        potential_matches = [None for f in files]
-
-        # Iterate through these files, and query the cache for potential
-        #  matches.
-        for f in files:
-          potential_matches[f['index']] = self.cache.getAllFilesOfSize(f['size'])
-
-        # 2. Call LocalBFF to match the files
         metafile_dict = {"info": bencode.bdecode(current_torrent.torrent_info.metadata())}
+        if potential_matches is None:
+            potential_matches = self.get_potential_matches(
+                files, get_pad_file_indices(metafile_dict['info'])
+            )
+
+        # 2. Call LocalBFF to match the files, in a thread so that the
+        #     reactor is free while the potential matches are read.
+        self.prefer_indexed_head_match(metafile_dict['info'], files, potential_matches)
         log.debug("Metafile data obtained. Passing on to LocalBFF.")
-        matcher = match(
-          fastVerification=True,
+        finder = get_finder(
+          fastVerification=self.config['fastVerification'],
           metafileDict=metafile_dict,
-          potentialMatches=potential_matches
+          potentialMatches=potential_matches,
+          hashCache=self.hash_cache,
+          numberOfThreads=self.config['verificationThreads'],
+          memoryLimit=self.config['verificationMemoryLimit'],
+          statCache=self.stat_cache,
+          sequentialReads=self.config['sequentialReads'],
+          reader=self.config['candidateReader'],
+          dropReadRanges=self.config['dropReadsFromPageCache'],
+          ioScheduler=self.io_scheduler
         )
+        job.on_cancel = finder.cancel
+
+        d = threads.deferToThread(self.verify_matches, finder)
+        d.addCallback(self.apply_matches, job, finder)
+        return d
+
+
+    def verify_matches(self, finder):
+        # Called in a thread. Returns whether the recheck of the torrent may
+        #  be skipped. libtorrent seeds the pieces handed to it as resume
+        #  data as they are, so the recheck is only skipped when every piece
+        #  was hashed from the matched files, which fast verification does
+        #  not do.
+        finder.positivelyMatchFilesInMetafileToPossibleMatches()
         log.info("Searching for positive matches complete!")
 
+        return (
+            not finder.isCancelled and
+            self.config['skipRecheck'] and
+            are_all_files_positively_matched(finder) and
+            all(finder.getHashedPieces()) and
+            finder.recheckSampleOfVerifiedPieces(self.config['recheckSampleSize'])
+        )
+
+
+    def apply_matches(self, skip_recheck, job, matcher):
+        # 3. Back on the reactor, relink the torrent to its matches.
+        torrent_id = job.torrent_id
+
+        # Possible matches that could not be read are skipped by later
+        #  searches once they keep failing.
+        if matcher.unreadablePaths:
+          self.cache.markUnreadableFiles(list(matcher.unreadablePaths))
+
+        if job.cancelled:
+          log.info("Relinking of torrent {0} was cancelled".format(torrent_id))
+          return
+
+        torrent_manager = component.get("Core").torrentmanager
+        if torrent_id not in torrent_manager.torrents:
+          log.info("Torrent {0} was removed while relinking".format(torrent_id))
+          return
+        current_torrent = torrent_manager.torrents[torrent_id]
+
         # If all files are positively matched, then the torrent should be
         #  relinked and set to a seeding state.
-        all_files_positively_matched = True
-        for f in matcher.files:
-          if f.status != "MATCH_FOUND":
-            all_files_positively_matched = False
+        all_files_positively_matched = are_all_files_positively_matched(matcher)
 
         # If there is some file that is not fully matched, then we must check
         #  the default action as specified by the user.
@@ -345,15 +760,26 @@ class Core(CorePluginBase):
             log.info("Some files had no positive matches."
                      " Seeding the matches, downloading the rest")
 
-          log.info("Pausing torrent for relinking...")
-          current_torrent.pause()
-          #matcher.relink(current_torrent.get_options()['download_location'])
-          self.move_storage_and_relink(current_torrent, matcher)
-          
-          log.info("Forcing recheck...")
-          current_torrent.force_recheck()
-          log.info("Resuming torrent...")
-          current_torrent.resume()
+          if skip_recheck and self.readd_with_resume_data(current_torrent, matcher):
+            log.info("Torrent re-added with resume data, skipping recheck.")
+
+          else:
+            # A torrent that could not be re-added with resume data has been
+            #  added back as it was, if at all.
+            if torrent_id not in torrent_manager.torrents:
+              log.error("Torrent {0} is gone, not relinking it".format(torrent_id))
+              return
+            current_torrent = torrent_manager.torrents[torrent_id]
+
+            log.info("Pausing torrent for relinking...")
+            current_torrent.pause()
+            #matcher.relink(current_torrent.get_options()['download_location'])
+            self.move_storage_and_relink(current_torrent, matcher)
+            
+            log.info("Forcing recheck...")
+            current_torrent.force_recheck()
+            log.info("Resuming torrent...")
+            current_torrent.resume()
 
         elif self.config['defaultAction'] == 1:
           log.info("Some files had no positive matches. Deleting torrent.")
@@ -375,9 +801,7 @@ class Core(CorePluginBase):
         # NOTE: this may be a problem for Windows users, who store files on
         #  one hard drive (C:/ drive) and another hard drive (D:/ drive).
 
-        common_subdirectory = os.path.split(os.path.commonprefix(
-            [f.getMatchedPathFromContentDirectory() for f in matcher.files if f.status == "MATCH_FOUND"]
-        ))[0]
+        common_subdirectory = self.get_common_subdirectory(matcher)
         
         # If a Windows user has one file on C:/, and another file on D:/,
         #  then common_subdirectory will be empty.
@@ -404,6 +828,94 @@ class Core(CorePluginBase):
             self.rename(current_torrent, rename_struct, common_subdirectory)
 
 
+    def get_common_subdirectory(self, matcher):
+        return os.path.split(os.path.commonprefix(
+            [f.getMatchedPathFromContentDirectory() for f in matcher.files if f.status == "MATCH_FOUND"]
+        ))[0]
+
+
+    def readd_with_resume_data(self, current_torrent, matcher):
+        # Rather than moving the storage, renaming the files and having
+        #  libtorrent recheck every piece LocalBFF has just verified, the
+        #  torrent is removed and added again, pointing at the matched files,
+        #  along with resume data that marks the verified pieces as present.
+        torrent_id = current_torrent.torrent_id
+        torrent_file = os.path.join(
+            deluge.configmanager.get_config_dir(),
+            "state",
+            torrent_id + ".torrent"
+        )
+        common_subdirectory = self.get_common_subdirectory(matcher)
+        if not common_subdirectory or not os.path.exists(torrent_file):
+            log.info("Cannot re-add torrent {0} with resume data".format(torrent_id))
+            return False
+
+        with open(torrent_file, 'rb') as f:
+            filedump = f.read()
+
+        mapped_files = {}
+        file_sizes = []
+        for i, f in enumerate(matcher.files):
+            if f.isPadFile:
+                file_sizes.append([0, 0])
+                continue
+            matched_path = f.getMatchedPathFromContentDirectory()
+            mapped_files[i] = os.path.relpath(matched_path, common_subdirectory)
+            file_sizes.append([
+                os.path.getsize(matched_path),
+                int(os.path.getmtime(matched_path))
+            ])
+
+        # In seed mode, libtorrent still hashes each piece the first time it
+        #  is uploaded, rather than all of them up front.
+        resume_data = {
+            "file-format": "libtorrent resume file",
+            "file-version": 1,
+            "info-hash": binascii.unhexlify(torrent_id),
+            "pieces": "\x01"*matcher.metafile.numberOfPieces,
+            "file sizes": file_sizes,
+            "save_path": common_subdirectory,
+            "mapped_files": [mapped_files.get(i, "") for i in range(len(matcher.files))],
+            "seed_mode": 1,
+        }
+
+        original_options = dict(current_torrent.get_options())
+        options = dict(original_options)
+        options["download_location"] = common_subdirectory
+        options["mapped_files"] = mapped_files
+        options["add_paused"] = False
+        trackers = current_torrent.trackers
+
+        log.info("Re-adding torrent {0} with resume data, saved to {1}".format(
+            torrent_id, common_subdirectory
+        ))
+        torrent_manager = component.get("Core").torrentmanager
+        torrent_manager.remove(torrent_id, remove_data=False)
+        self.readded_torrents.add(torrent_id)
+        readded_id = torrent_manager.add(
+            filedump=filedump,
+            options=options,
+            resume_data=bencode.bencode(resume_data)
+        )
+        if readded_id is None:
+            # The torrent is added back as it was, to be rechecked instead.
+            log.warning("Could not re-add torrent {0} with resume data,"
+                        " restoring it".format(torrent_id))
+            readded_id = torrent_manager.add(
+                filedump=filedump,
+                options=original_options
+            )
+            if readded_id is None:
+                self.readded_torrents.discard(torrent_id)
+                log.error("Could not restore torrent {0}".format(torrent_id))
+                return False
+            torrent_manager.torrents[readded_id].set_trackers(trackers)
+            return False
+
+        torrent_manager.torrents[readded_id].set_trackers(trackers)
+        return True
+
+
     def rename(self, current_torrent, matches, download_location):
         renaming_struct = []
         rel_path_index = len(download_location)+1
@@ -1,13 +1,14 @@
-import itertools
 from hashlib import sha1
 import logging
 from utils import binToBase64
 
-class AllContributingFilesToPiece:
+class AllContributingFilesToPiece(object):
+  __slots__ = ('listOfContributingFiles', 'combinationProducesPositiveHashMatch')
+  logger = logging.getLogger(__name__)
+
   def __init__(self, listOfContributingFiles=None):
     self.listOfContributingFiles = listOfContributingFiles
     self.combinationProducesPositiveHashMatch = None
-    self.logger = logging.getLogger(__name__)
   
   def addContributingFile(self, newFile):
     if self.listOfContributingFiles == None:
@@ -15,46 +16,117 @@ class AllContributingFilesToPiece:
     
     self.listOfContributingFiles.append(newFile)
   
+  def getLastContributingFile(self):
+    if not self.listOfContributingFiles:
+      return None
+    return self.listOfContributingFiles[-1]
+  
   def getNumberOfFiles(self):
     return len(self.listOfContributingFiles)
   
-  def findCombinationThatMatchesReferenceHash(self, hash):
-    cartesianProductOfPossibleFilePathMatches = self.buildCartesianProductOfPossibleFilePathMatches()
-    
+  def findCombinationThatMatchesReferenceHash(self, hash, hashCache=None, checkAllPossibleMatches=False, hashingPool=None, buffer=None, reader=None):
     self.logger.debug("Processing through all possible file path combinations...")
     self.logger.debug("  Worst-case scenario of all combinations to process: {0}".format(
       self.getCardinalityOfCartesianProductOfAllPossibleCombinations()
     ))
     self.logger.debug("  Files contributing to piece => {0}".format(self.getNumberOfFiles()))
-    
-    for combination in cartesianProductOfPossibleFilePathMatches:
-      self.logger.debug("    Checking combination => " + "\n      ".join(combination) )
-      self.applyCombinationToContributingFiles(combination)
 
-      self.logger.debug("      Building up piece from possible file combination")
-      data = self.getData()
-      computedHash = sha1(data).digest()
+    # A piece lying wholly inside of one file may be checked against all
+    #  of the file's possible matches, rather than stopping at the first
+    #  match, in order to eliminate every possible match that is not a copy.
+    checkAllPossibleMatches = checkAllPossibleMatches and self.getNumberOfFiles() == 1
+
+    self.combinationProducesPositiveHashMatch = False
+    matchedCombination = None
+    failedCombinations = []
+    for combination, computedHash in self.hashAllPossibleCombinations(hashCache, hashingPool, buffer, reader):
       self.logger.debug("      Computed hash for data => " + binToBase64(computedHash))
       
-      self.combinationProducesPositiveHashMatch = (computedHash == hash)
-      
-      if self.combinationProducesPositiveHashMatch:
-        self.logger.debug("      Combination found! Ending search now.")
+      if computedHash == hash:
+        if self.combinationProducesPositiveHashMatch:
+          self.logger.debug("      Combination also matches.")
+          continue
+
+        self.combinationProducesPositiveHashMatch = True
+        matchedCombination = combination
         self.updateReferenceFilesWithAppropriateMatchedPaths()
         self.updateStatusOfReferenceFiles("MATCH_FOUND")
-        break
+        if not checkAllPossibleMatches:
+          self.logger.debug("      Combination found! Ending search now.")
+          break
       else:
         self.logger.debug("      Combination does not match :( moving on to next combination")
         self.logger.debug("~"*80)
         self.updateStatusOfReferenceFiles("CHECKED_WITH_NO_MATCH")
+        failedCombinations.append(combination)
+
+    self.eliminatePathsOfFailedCombinations(failedCombinations, matchedCombination)
   
-  def buildCartesianProductOfPossibleFilePathMatches(self):
-    listOfListOfFilePaths = []
-    for contributingFile in self.listOfContributingFiles:
-      listOfListOfFilePaths.append(contributingFile.getAllPossibleFilePaths())
-    
-    cartesianProduct = itertools.product(*listOfListOfFilePaths)
-    return cartesianProduct
+  def eliminatePathsOfFailedCombinations(self, failedCombinations, matchedCombination):
+    # A path that does not produce a piece lying wholly inside of its file
+    #  is not a copy of the file. A combination of several files that does
+    #  not match can only be blamed on one of them when it differs from the
+    #  combination matching the same piece by the path of that file alone,
+    #  since the data of the other files is then known to be right. Nothing
+    #  is blamed when no combination matches.
+    eliminatedPaths = {}
+    for combination in failedCombinations:
+      if self.getNumberOfFiles() == 1:
+        blamedFiles = [0]
+      elif matchedCombination is None:
+        break
+      else:
+        blamedFiles = [i for i, path in enumerate(combination) if path != matchedCombination[i]]
+      if len(blamedFiles) == 1:
+        referenceFile = self.listOfContributingFiles[blamedFiles[0]].referenceFile
+        eliminatedPaths.setdefault(referenceFile, []).append(combination[blamedFiles[0]])
+
+    for referenceFile, paths in eliminatedPaths.items():
+      self.logger.debug("  Eliminating {0} possible matches of {1}".format(len(paths), referenceFile))
+      referenceFile.eliminatePossibleMatches(paths)
+  
+  def hashAllPossibleCombinations(self, hashCache=None, hashingPool=None, buffer=None, reader=None):
+    # The data of each contributing file is read by the reader, into the
+    #  buffer if one is given, and hashed from there. Since a file's data
+    #  is added to the hash of its prefix as soon as it is read, one buffer
+    #  holding a whole piece serves every file of every combination.
+    possibleFilePaths = [f.getAllPossibleFilePaths() for f in self.listOfContributingFiles]
+
+    if self.getNumberOfFiles() == 1:
+      # The piece lies wholly inside of one file, so its hash may already
+      #  be known from a previous check of the same file.
+      contributingFile = self.listOfContributingFiles[0]
+      for path in possibleFilePaths[0]:
+        self.logger.debug("    Checking possible match => " + path)
+        contributingFile.possibleMatchPath = path
+        yield (path,), contributingFile.getDigest(hashCache, hashingPool, buffer, reader)
+
+    else:
+      for combinationAndHash in self.hashCombinationsSharingPrefix(possibleFilePaths, sha1(), (), buffer, reader):
+        yield combinationAndHash
+  
+  def hashCombinationsSharingPrefix(self, possibleFilePaths, prefixHash, prefix, buffer=None, reader=None):
+    # The cartesian product of possible paths is walked as a tree, one
+    #  contributing file per level. The hash of the piece data built up by
+    #  a branch is copied to each of its children, so that the data of a
+    #  file is only read and hashed once for every distinct prefix of paths
+    #  rather than once for every combination.
+    depth = len(prefix)
+    contributingFile = self.listOfContributingFiles[depth]
+    isFinalFile = (depth == self.getNumberOfFiles() - 1)
+
+    for path in possibleFilePaths[depth]:
+      contributingFile.possibleMatchPath = path
+      pieceHash = prefixHash.copy()
+      pieceHash.update(contributingFile.getData(buffer, reader))
+      combination = prefix + (path,)
+
+      if isFinalFile:
+        self.logger.debug("    Checking combination => " + "\n      ".join(combination) )
+        yield combination, pieceHash.digest()
+      else:
+        for combinationAndHash in self.hashCombinationsSharingPrefix(possibleFilePaths, pieceHash, combination, buffer, reader):
+          yield combinationAndHash
   
   def getCardinalityOfCartesianProductOfAllPossibleCombinations(self):
     cardinality = 1
@@ -63,16 +135,6 @@ class AllContributingFilesToPiece:
     
     return cardinality
   
-  def applyCombinationToContributingFiles(self, combination):
-    for path, contributingFile in zip(combination, self.listOfContributingFiles):
-      contributingFile.possibleMatchPath = path
-  
-  def getData(self):
-    data = ''
-    for contributingFile in self.listOfContributingFiles:
-      data += contributingFile.getData()
-    return data
-  
   def updateReferenceFilesWithAppropriateMatchedPaths(self):
     for contributingFile in self.listOfContributingFiles:
       contributingFile.applyCurrentMatchPathToReferenceFileAsPositiveMatchPath()
@@ -91,3 +153,10 @@ class AllContributingFilesToPiece:
 
     return True
 
+  def haveKeptMatchedPaths(self):
+    for contributingFile in self.listOfContributingFiles:
+      if not contributingFile.hasKeptMatchedPath():
+        return False
+
+    return True
+
@@ -1,4 +1,7 @@
 import logging
+from hashlib import sha1
+from hashcache import getFileIdentity
+from readers import BufferedReader
 module_logger = logging.getLogger(__name__)
 
 
@@ -59,14 +62,19 @@ def getFromMetafilePieceAndFileObjects(piece, file):
   module_logger.debug("FileContributingToPiece building complete!")
   return fcp
 
-class FileContributingToPiece:
+class FileContributingToPiece(object):
+  __slots__ = ('seekOffset', 'readOffset', 'padding', 'referenceFile', 'possibleMatchPath')
+  logger = logging.getLogger(__name__)
+
   def __init__(self, seek, read, referenceFile, possibleMatchPath=None):
     self.seekOffset = seek
     self.readOffset = read
     self.referenceFile = referenceFile
     self.possibleMatchPath = possibleMatchPath
 
-    self.logger = logging.getLogger(__name__)
+    # The number of zeros, from the pad files following the file, that end
+    #  the piece data past the end of the file.
+    self.padding = 0
   
   def __repr__(self):
     return self.__str__()
@@ -75,26 +83,59 @@ class FileContributingToPiece:
     output = __name__
     output += "\n  Metafile info: {0}".format(self.referenceFile)
     output += "\n  File substream: (Seek={0}B, Read={1}B)".format(self.seekOffset, self.readOffset)
+    if self.padding:
+      output += "\n  Padding: {0}B".format(self.padding)
     if self.possibleMatchPath:
       output += "\n  Possible match path: {0}".format(self.possibleMatchPath)
     return output
   
   def getAllPossibleFilePaths(self):
+    # The path already matched by another piece is the most likely to match
+    #  this piece as well, so it is tried before the file's other remaining
+    #  possible matches.
     if self.referenceFile.status == "MATCH_FOUND":
-      return [self.referenceFile.matchedFilePath]
+      matchedFilePath = self.referenceFile.matchedFilePath
+      return [matchedFilePath] + [p for p in self.referenceFile.possibleMatches if p != matchedFilePath]
     else:
       return self.referenceFile.possibleMatches
   
-  def getData(self):
-    data = ''
-    with open(self.possibleMatchPath, 'rb') as possibleMatchedFile:
-      possibleMatchedFile.seek(self.seekOffset)
-      data = possibleMatchedFile.read(self.readOffset)
-    
-    return data
+  def getData(self, buffer=None, reader=None, readOnce=False):
+    # The data is read by the reader given, into the buffer if one is
+    #  given, and a view of it is returned. The buffer must hold the range
+    #  along with its padding.
+    if buffer is None:
+      buffer = bytearray(self.readOffset + self.padding)
+    if reader is None:
+      reader = BufferedReader()
+    return reader.read(self.possibleMatchPath, self.seekOffset, self.readOffset, self.padding, buffer, readOnce)
+
+  def getDigest(self, hashCache=None, hashingPool=None, buffer=None, reader=None):
+    if hashingPool is not None:
+      # The pool looks the range up in the hash cache itself.
+      return hashingPool.getDigest(self.possibleMatchPath, self.seekOffset, self.readOffset, self.padding)
+
+    # A range lying inside of one file is only read once from each possible
+    #  match, unlike the ranges of files combined with others.
+    if hashCache is None:
+      return sha1(self.getData(buffer, reader, readOnce=True)).digest()
+
+    # The range of a padded piece runs past the end of the file, which no
+    #  range read from the file alone does, so the zeros are part of the
+    #  key the range is cached under.
+    identity = getFileIdentity(self.possibleMatchPath)
+    length = self.readOffset + self.padding
+    digest = hashCache.lookup(identity, self.seekOffset, length)
+    if digest is None:
+      digest = sha1(self.getData(buffer, reader, readOnce=True)).digest()
+      hashCache.store(identity, self.seekOffset, length, digest)
+    else:
+      self.logger.debug("      Hash cache hit for {0}".format(self.possibleMatchPath))
+    return digest
   
   def applyCurrentMatchPathToReferenceFileAsPositiveMatchPath(self):
     self.logger.debug("Applying {0} to {1}".format(self.possibleMatchPath, self.referenceFile))
+    if self.referenceFile.matchedFilePath not in (None, self.possibleMatchPath):
+      self.referenceFile.matchedPathChanged = True
     self.referenceFile.matchedFilePath = self.possibleMatchPath
   
   def updateStatus(self, status):
@@ -108,3 +149,5 @@ class FileContributingToPiece:
   def hasBeenMatched(self):
     return (self.referenceFile.status == "MATCH_FOUND")
 
+  def hasKeptMatchedPath(self):
+    return self.hasBeenMatched() and not self.referenceFile.matchedPathChanged
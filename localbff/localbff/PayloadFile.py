@@ -2,6 +2,7 @@ import logging
 import json
 import os
 from utils import isSingleFileMetafile
+from utils import isPadFile
 module_logger = logging.getLogger(__name__)
 
 
@@ -9,6 +10,17 @@ def getPayloadFilesFromMetafileDict(metafileDict):
   module_logger.debug("Extracting file information from metafile dictionary")
   files = []
   payloadDirectory = metafileDict['info']['name'].decode('utf-8')
+
+  # A v2 metafile (BEP 52) lists its files in a file tree, along with the
+  #  root of the merkle tree of each file. A hybrid metafile has both the
+  #  file tree and the v1 list of files.
+  piecesRoots = {}
+  if 'file tree' in metafileDict['info']:
+    fileTree = getFilesFromFileTree(metafileDict['info']['file tree'])
+    if not isV1Metafile(metafileDict):
+      return getPayloadFilesFromFileTree(fileTree, payloadDirectory)
+    for filePath, size, piecesRoot in fileTree:
+      piecesRoots[filePath] = piecesRoot
   
   if isSingleFileMetafile(metafileDict):
     module_logger.debug('Metafile is in single-file mode')
@@ -19,7 +31,8 @@ def getPayloadFilesFromMetafileDict(metafileDict):
     size = metafileDict['info']['length']
     module_logger.debug("  Filesize => {0} Bytes".format(size))
     
-    files.append( PayloadFile(path="", filename=filename, size=size, streamOffset=0) )
+    piecesRoot = piecesRoots.get((metafileDict['info']['name'],))
+    files.append( PayloadFile(path="", filename=filename, size=size, streamOffset=0, piecesRoot=piecesRoot) )
   
   else:
     module_logger.debug('Metafile is in multi-file mode')
@@ -47,7 +60,8 @@ def getPayloadFilesFromMetafileDict(metafileDict):
       streamOffset = currentStreamOffset
       module_logger.debug("  Payload offset => {0} Bytes".format(streamOffset))
       
-      files.append( PayloadFile(path=path, filename=filename, size=size, streamOffset=streamOffset, index=index+1) )
+      piecesRoot = piecesRoots.get(tuple(currentFile['path']))
+      files.append( PayloadFile(path=path, filename=filename, size=size, streamOffset=streamOffset, index=index+1, piecesRoot=piecesRoot, isPadFile=isPadFile(currentFile)) )
       
       module_logger.debug("END: Decoding file #{0}".format(i+1))
       currentStreamOffset += size
@@ -56,8 +70,49 @@ def getPayloadFilesFromMetafileDict(metafileDict):
   return files
 
 
+def isV1Metafile(metafileDict):
+  return 'files' in metafileDict['info'] or 'length' in metafileDict['info']
+
+
+def getFilesFromFileTree(fileTree, directories=()):
+  # Returns the path, as a tuple, the size and the pieces root of every file
+  #  in a v2 file tree, in the order of the files in the payload. A file is
+  #  a dictionary keyed by the empty string, and an empty file has no
+  #  pieces root.
+  files = []
+  for name in sorted(fileTree.keys()):
+    node = fileTree[name]
+    if '' in node:
+      files.append((directories + (name,), node['']['length'], node[''].get('pieces root')))
+    else:
+      files.extend(getFilesFromFileTree(node, directories + (name,)))
+  return files
+
+
+def getPayloadFilesFromFileTree(fileTree, payloadDirectory):
+  module_logger.debug('Metafile is a v2 metafile')
+  files = []
+
+  if len(fileTree) == 1 and len(fileTree[0][0]) == 1 and fileTree[0][0][0].decode('utf-8') == payloadDirectory:
+    # A single file, named as the payload, is not put in a directory.
+    filePath, size, piecesRoot = fileTree[0]
+    files.append( PayloadFile(path="", filename=payloadDirectory, size=size, streamOffset=0, piecesRoot=piecesRoot) )
+
+  else:
+    currentStreamOffset = 0
+    for i, (filePath, size, piecesRoot) in enumerate(fileTree):
+      path = os.path.join(payloadDirectory, *filePath[:-1])
+      filename = filePath[-1].decode('utf-8')
+      module_logger.debug("  File #{0} => {1} ({2} Bytes)".format(i+1, os.path.join(path, filename), size))
+      files.append( PayloadFile(path=path, filename=filename, size=size, streamOffset=currentStreamOffset, index=i+1, piecesRoot=piecesRoot) )
+      currentStreamOffset += size
+
+  module_logger.debug("File information decoding complete!")
+  return files
+
+
 class PayloadFile:
-  def __init__(self, path, filename, size, streamOffset, index=1):
+  def __init__(self, path, filename, size, streamOffset, index=1, piecesRoot=None, isPadFile=False):
     self.path = path
     self.filename = filename
     self.size = size
@@ -67,6 +122,18 @@ class PayloadFile:
     self.status = "NOT_CHECKED"
     self.index = index
 
+    # The root of the merkle tree of the file, in a v2 metafile.
+    self.piecesRoot = piecesRoot
+
+    # A pad file is made of zeros, and is never looked for on disk.
+    self.isPadFile = isPadFile
+    self.possibleMatches = []
+
+    # Set once the file is matched to another path than the one it was
+    #  matched to before, since the pieces hashed before may not be
+    #  produced by the path it is matched to now.
+    self.matchedPathChanged = False
+
 
   def __repr__(self):
     return self.__str__()
@@ -103,6 +170,19 @@ class PayloadFile:
     return pieceIsWholelyContainedInFile or fileIsWholelyContainedInPiece or fileIsPartiallyContainedInPiece
 
 
+  def eliminatePossibleMatches(self, paths):
+    eliminated = set(paths)
+    self.possibleMatches = [p for p in self.possibleMatches if p not in eliminated]
+
+    # A path matched by some earlier piece may turn out not to be a copy of
+    #  this file after all.
+    if self.matchedFilePath in eliminated:
+      module_logger.debug("Previous match {0} eliminated for {1}".format(self.matchedFilePath, self))
+      self.matchedFilePath = None
+      self.matchedPathChanged = True
+      self.status = "CHECKED_WITH_NO_MATCH"
+
+
   def hasNotBeenMatched(self):
     return not bool( self.matchedFilePath )
 
@@ -1,54 +1,56 @@
 import logging
+from bisect import bisect_left, bisect_right
+from hashlib import sha1
 from utils import isSingleFileMetafile
 from utils import binToBase64
+from PayloadFile import getFilesFromFileTree
 from AllContributingFilesToPiece import AllContributingFilesToPiece
 from FileContributingToPiece import getFromMetafilePieceAndFileObjects
+from buffers import BufferPool
+from readers import BufferedReader
 module_logger = logging.getLogger(__name__)
 
+SHA1_HASH_LENGTH = 20
+
 
 def getPiecesFromMetafileDict( metafileDict, files ):
   module_logger.debug("Extracting piece information from metafile dictionary")
 
   payloadSize = getPayloadSizeFromMetafileDict(metafileDict)
   module_logger.debug('  Payload size => ' + str(payloadSize) + ' Bytes')
-  
-  hashes = getHashesFromMetafileDict(metafileDict)
-  
+
   pieceSize = getPieceSizeFromDict(metafileDict)
   module_logger.debug('  Piece size => ' + str(pieceSize) + " Bytes")
 
-  finalPieceSize = getFinalPieceSizeFromDict(metafileDict)
-  module_logger.debug("  Final piece size => " + str(finalPieceSize) + " Bytes")
-
-  pieces = []
-  streamOffset = 0
-  numberOfPieces = getNumberOfPiecesFromDict(metafileDict)
-  module_logger.debug("  Number of pieces => " + str(numberOfPieces))
-
-  module_logger.debug("  Initializing list of PayloadPieces")
-  for pieceIndex in range(numberOfPieces-1):
-    module_logger.debug("Constructing piece #" + str(pieceIndex+1))
-    piece = PayloadPiece(size=pieceSize, hash=hashes[pieceIndex], streamOffset=streamOffset, index=pieceIndex+1)
-    piece.setContributingFilesFromAllFiles(files)
-    module_logger.debug(piece.__str__())
-    
-    pieces.append(piece)
-    streamOffset += pieceSize
-    module_logger.debug("~"*80)
-
-  module_logger.debug("Constructing piece #" + str(numberOfPieces))
-  finalPiece = PayloadPiece(size=finalPieceSize, hash=hashes[-1], streamOffset=streamOffset, index=numberOfPieces)
-  finalPiece.setContributingFilesFromAllFiles(files)
-  module_logger.debug(finalPiece.__str__())
-
-  pieces.append(finalPiece)
+  # A v2 metafile has no v1 pieces, its files being checked against the
+  #  root of their own merkle trees instead.
+  pieces = PayloadPieces(
+    concatenatedHashes=metafileDict['info'].get('pieces', b''),
+    pieceSize=pieceSize,
+    payloadSize=payloadSize,
+    files=files
+  )
+  module_logger.debug("  Number of pieces => " + str(len(pieces)))
+  module_logger.debug("  Final piece size => " + str(pieces.finalPieceSize) + " Bytes")
 
   module_logger.debug("Piece information decoding complete!")
   return pieces
 
+def getFilesOverlappingPiece(piece, files, fileStartingOffsets, fileEndingOffsets):
+  # The files are laid out one after another in the payload, so both their
+  #  starting and their ending offsets are sorted. Only the files from the
+  #  first one ending at or after the start of the piece, up to the last one
+  #  starting at or before the end of the piece, can contribute to it.
+  first = bisect_left(fileEndingOffsets, piece.streamOffset)
+  last = bisect_right(fileStartingOffsets, piece.endingOffset)
+  return files[first:last]
+
 def getPayloadSizeFromMetafileDict( metafileDict ):
   if isSingleFileMetafile(metafileDict):
     return metafileDict['info']['length']
+
+  elif 'files' not in metafileDict['info']:
+    return sum(length for path, length, piecesRoot in getFilesFromFileTree(metafileDict['info']['file tree']))
   
   else:
     payloadSize = 0
@@ -56,35 +58,114 @@ def getPayloadSizeFromMetafileDict( metafileDict ):
         payloadSize += f['length']
     return payloadSize
 
-def getHashesFromMetafileDict(metafileDict):
-  concatenatedHashes = metafileDict['info']['pieces']
-  return splitConcatenatedHashes(concatenatedHashes)
-
-def splitConcatenatedHashes(concatenatedHashes):
-  SHA1_HASH_LENGTH = 20
-  return [concatenatedHashes[start:start+SHA1_HASH_LENGTH] for start in range(0, len(concatenatedHashes), SHA1_HASH_LENGTH)]
-
 def getPieceSizeFromDict(metafileDict):
   return metafileDict['info']['piece length']
 
-def getFinalPieceSizeFromDict(metafileDict):
-  return getPayloadSizeFromMetafileDict(metafileDict) % getPieceSizeFromDict(metafileDict)
+class PayloadPieces(object):
+  """The pieces of a metafile, kept as compactly as possible. The hashes
+  are views into the concatenated hashes of the metafile, the offsets of a
+  piece are computed from its index, and only two flags per piece are
+  stored, to remember whether it has been verified, and whether it was
+  hashed to be so rather than trusted. A PayloadPiece, along with the
+  files contributing to it, is only built when the piece is accessed, and
+  can be thrown away once it has been matched."""
+  def __init__(self, concatenatedHashes, pieceSize, payloadSize, files):
+    self.hashes = memoryview(concatenatedHashes)
+    self.numberOfPieces = len(concatenatedHashes) // SHA1_HASH_LENGTH
+    self.pieceSize = pieceSize
+    self.payloadSize = payloadSize
+    self.finalPieceSize = payloadSize - (self.numberOfPieces-1)*pieceSize if self.numberOfPieces else 0
+    self.verified = bytearray(self.numberOfPieces)
+    self.hashed = bytearray(self.numberOfPieces)
+
+    # Pieces are read into buffers of the piece size, kept for reuse, by
+    #  the reader chosen for the storage of the possible matches.
+    self.buffers = BufferPool(pieceSize)
+    self.reader = BufferedReader()
 
-def getNumberOfPiecesFromDict(metafileDict):
-  return len(getHashesFromMetafileDict(metafileDict))
+    self.files = files
+    self.fileStartingOffsets = [f.streamOffset for f in files]
+    self.fileEndingOffsets = [f.endingOffset for f in files]
 
-class PayloadPiece:
-  def __init__(self, size, streamOffset, hash, index):
+  def __len__(self):
+    return self.numberOfPieces
+
+  def __iter__(self):
+    for i in range(self.numberOfPieces):
+      yield self[i]
+
+  def __getitem__(self, i):
+    if i < 0:
+      i += self.numberOfPieces
+    if not 0 <= i < self.numberOfPieces:
+      raise IndexError("piece index out of range")
+
+    if i == self.numberOfPieces-1:
+      size = self.finalPieceSize
+    else:
+      size = self.pieceSize
+
+    piece = PayloadPiece(
+      size=size,
+      streamOffset=i*self.pieceSize,
+      hash=self.hashes[i*SHA1_HASH_LENGTH:(i+1)*SHA1_HASH_LENGTH].tobytes(),
+      index=i+1,
+      pieces=self
+    )
+    piece.setContributingFilesFromAllFiles(
+      getFilesOverlappingPiece(piece, self.files, self.fileStartingOffsets, self.fileEndingOffsets)
+    )
+    return piece
+
+class PayloadPiece(object):
+  __slots__ = ('size', 'streamOffset', 'endingOffset', 'hash', 'index', 'contributingFiles', 'pieces', '_isVerified', '_isHashed')
+  logger = logging.getLogger('deluge.plugin.LocalBFF.common.PayloadPiece')
+
+  def __init__(self, size, streamOffset, hash, index, pieces=None):
     self.size = size
     self.streamOffset = streamOffset
     self.endingOffset = streamOffset+size
     self.hash = hash
-    self.b64_hash = binToBase64(hash)
     self.index = index
     self.contributingFiles = AllContributingFilesToPiece()
-    self.isVerified = False
 
-    self.logger = logging.getLogger('deluge.plugin.LocalBFF.common.PayloadPiece')
+    # A piece belonging to a PayloadPieces remembers whether it has been
+    #  verified there, so that the flag outlives this object.
+    self.pieces = pieces
+    self._isVerified = False
+    self._isHashed = False
+
+  @property
+  def b64_hash(self):
+    return binToBase64(self.hash)
+
+  @property
+  def isVerified(self):
+    if self.pieces is None:
+      return self._isVerified
+    return bool(self.pieces.verified[self.index-1])
+
+  @isVerified.setter
+  def isVerified(self, isVerified):
+    if self.pieces is None:
+      self._isVerified = isVerified
+    else:
+      self.pieces.verified[self.index-1] = bool(isVerified)
+
+  @property
+  def isHashed(self):
+    # Whether the piece was verified by hashing the data of its files,
+    #  rather than trusted since they have all been matched.
+    if self.pieces is None:
+      return self._isHashed
+    return bool(self.pieces.hashed[self.index-1])
+
+  @isHashed.setter
+  def isHashed(self, isHashed):
+    if self.pieces is None:
+      self._isHashed = isHashed
+    else:
+      self.pieces.hashed[self.index-1] = bool(isHashed)
   
   def __repr__(self):
     return self.__str__()
@@ -99,11 +180,19 @@ class PayloadPiece:
     for payloadFile in allFiles:
       if payloadFile.contributesTo(self):
         contributingFile = getFromMetafilePieceAndFileObjects(piece=self, file=payloadFile)
-        self.contributingFiles.addContributingFile( contributingFile )
+
+        # The zeros of a pad file are read as part of the file before it, so
+        #  that a piece holding the end of one file and its padding is
+        #  checked as a piece lying inside of one file.
+        previousFile = self.contributingFiles.getLastContributingFile()
+        if payloadFile.isPadFile and previousFile is not None and not previousFile.referenceFile.isPadFile:
+          previousFile.padding += contributingFile.readOffset
+        else:
+          self.contributingFiles.addContributingFile( contributingFile )
 
     self.logger.debug("END: Finding all files contributing to " + self.__str__())
 
-  def findMatch(self, fastVerification):
+  def findMatch(self, fastVerification, hashCache=None, hashingPool=None):
     if self.isVerifiable():
       doNotContinueWithMatch = (
         fastVerification and self.contributingFiles.haveBeenPositivelyMatched()
@@ -114,12 +203,60 @@ class PayloadPiece:
         self.isVerified = True
       else:
         self.logger.debug("Finding all matched files for " + self.__str__())
-        self.contributingFiles.findCombinationThatMatchesReferenceHash( hash=self.hash )
+        buffer = self.takeBuffer()
+        try:
+          self.contributingFiles.findCombinationThatMatchesReferenceHash(
+            hash=self.hash,
+            hashCache=hashCache,
+            checkAllPossibleMatches=not fastVerification,
+            hashingPool=hashingPool,
+            buffer=buffer,
+            reader=self.getReader()
+          )
+        finally:
+          self.giveBackBuffer(buffer)
         self.isVerified = self.contributingFiles.combinationProducesPositiveHashMatch
+        self.isHashed = self.isVerified
     else:
       self.contributingFiles.updateStatusOfReferenceFiles('UNVERIFIABLE')
       self.logger.debug(self.__str__() + " is not verifiable :(")
 
+  def submitToHashingPool(self, fastVerification, hashingPool):
+    # Only the possible matches of a piece lying wholly inside of one file
+    #  are hashed ahead of time, since these are always checked.
+    if self.isVerifiable() and self.contributingFiles.getNumberOfFiles() == 1:
+      if not (fastVerification and self.contributingFiles.haveBeenPositivelyMatched()):
+        contributingFile = self.contributingFiles.listOfContributingFiles[0]
+        for path in contributingFile.getAllPossibleFilePaths():
+          hashingPool.submit(path, contributingFile.seekOffset, contributingFile.readOffset, contributingFile.padding)
+
+  def isProducedByMatchedFiles(self):
+    pieceHash = sha1()
+    buffer = self.takeBuffer()
+    try:
+      for contributingFile in self.contributingFiles.listOfContributingFiles:
+        if not contributingFile.hasBeenMatched():
+          return False
+        contributingFile.possibleMatchPath = contributingFile.referenceFile.matchedFilePath
+        pieceHash.update(contributingFile.getData(buffer, self.getReader()))
+    finally:
+      self.giveBackBuffer(buffer)
+    return pieceHash.digest() == self.hash
+
+  def takeBuffer(self):
+    if self.pieces is None:
+      return bytearray(self.size)
+    return self.pieces.buffers.take()
+
+  def getReader(self):
+    if self.pieces is None:
+      return BufferedReader()
+    return self.pieces.reader
+
+  def giveBackBuffer(self, buffer):
+    if self.pieces is not None:
+      self.pieces.buffers.giveBack(buffer)
+
   def isVerifiable(self):
     return self.contributingFiles.doAllContributingFilesHaveAtLeastOnePossibleMatch()
 
@@ -0,0 +1,51 @@
+import threading
+
+# Zeros copied into a buffer for the pad files following the end of a file,
+#  a block at a time.
+ZEROS = memoryview(bytearray(64*1024))
+
+
+class BufferPool:
+  """Keeps the buffers that pieces are read into, so that each piece is read
+  into memory allocated once for the whole search rather than into a new
+  string. A buffer is taken for as long as a piece is read and hashed, and
+  given back once done."""
+  def __init__(self, bufferSize):
+    self.bufferSize = bufferSize
+    self.freeBuffers = []
+    self.lock = threading.Lock()
+
+
+  def take(self):
+    with self.lock:
+      if self.freeBuffers:
+        return self.freeBuffers.pop()
+    return bytearray(self.bufferSize)
+
+
+  def giveBack(self, buffer):
+    with self.lock:
+      self.freeBuffers.append(buffer)
+
+
+def readRange(openFile, buffer, length, padding=0):
+  # Reads length bytes from the current position of the file into the
+  #  beginning of the buffer, followed by padding zeros, and returns a view
+  #  of them. Past the end of the file, the view is short and not padded.
+  view = memoryview(buffer)
+  bytesRead = 0
+  while bytesRead < length:
+    n = openFile.readinto(view[bytesRead:length])
+    if not n:
+      return view[:bytesRead]
+    bytesRead += n
+
+  fillWithZeros(view, length, length + padding)
+  return view[:length + padding]
+
+
+def fillWithZeros(view, start, end):
+  while start < end:
+    n = min(len(ZEROS), end - start)
+    view[start:start+n] = ZEROS[:n]
+    start += n
@@ -1,138 +1,386 @@
 import sqlite3
 import logging
 import os
-from StringIO import StringIO
+import threading
+from scanner import walkDirectoryTrees, scanDirectory, getDirectoryState
+from scanner import errorEncounteredWhileWalking
 
 log = logging.getLogger(__name__)
 
+# The number of files and directories written to the cache at once while
+#  walking a content directory.
+WALK_CHUNK_SIZE = 10000
+
+
+def load(dirs, persistent_path=None, backend="memory", scanThreadsPerDevice=1):
+  # The cache is either kept in memory and copied to disk as it changes,
+  #  which makes lookups fastest, or queried on disk directly, which starts
+  #  at once and takes no memory for large content directories.
+  cacheExists = persistent_path and os.path.exists(persistent_path)
+  if backend == "disk" and persistent_path:
+    log.debug("Querying cache on disk at {0}".format(persistent_path))
+    cache = ContentDirectoryCache(db=openOnDisk(persistent_path), scanThreadsPerDevice=scanThreadsPerDevice)
+
+  elif cacheExists:
+    # The cache already exists on disk, so load it into memory.
+    log.debug("Cache already exists on disk. Loading into memory.")
+    cache = ContentDirectoryCache(
+      db=loadIntoMemory(persistent_path),
+      save_to=persistent_path,
+      scanThreadsPerDevice=scanThreadsPerDevice
+    )
 
-def load(dirs, persistent_path=None):
-
-    # Test if the cache exists on disk, and load it to memory.
-    #  From here: http://stackoverflow.com/a/10856450
-    if persistent_path and os.path.exists(persistent_path):
-      # The cache already exists on disk, so load it into memory.
-      log.debug("Cache already exists on disk. Loading into memory.")
-      file_con = sqlite3.connect(persistent_path)
-      tempfile = StringIO()
-      for line in file_con.iterdump():
-        l = "{0}\n".format(line)
-        tempfile.write(l)
-      file_con.close()
-      tempfile.seek(0)
-
-      # Create a database in memory and import from tempfile
-      db = sqlite3.connect(":memory:")
-      db.cursor().executescript(tempfile.read())
-      db.commit()
-      db.row_factory = sqlite3.Row
-
-      return ContentDirectoryCache(db=db, save_to=persistent_path)
-
-    else:
-      # The sqlite3 file db does not exist, a new database will need
-      #  to be created.
-      log.debug("A new cache will need to be built by walking the disk.")
-      cache = ContentDirectoryCache(save_to=persistent_path)
-
-      # Iterate through the provided directories, and add them to the
-      #  cache.
-      for d in dirs:
-        cache.addDirectory(d)
-
-      return cache
+  else:
+    cache = ContentDirectoryCache(save_to=persistent_path, scanThreadsPerDevice=scanThreadsPerDevice)
+
+  if not cacheExists:
+    # The sqlite3 file db does not exist, a new database will need
+    #  to be created.
+    log.debug("A new cache will need to be built by walking the disk.")
+
+    # Walk the provided directories, and add them to the cache.
+    cache.addDirectories(dirs)
+
+  return cache
+
+
+def loadIntoMemory(persistent_path):
+  db = sqlite3.connect(":memory:", check_same_thread=False)
+  file_con = sqlite3.connect(persistent_path)
+  # A cache saved with an older schema is migrated once, on disk.
+  ensureSchema(file_con)
+
+  if hasattr(file_con, "backup"):
+    # Copies the pages of the database file as they are.
+    file_con.backup(db)
+    file_con.close()
+    return db
+
+  # Without the backup API (Python < 3.7), the tables are copied over by
+  #  SQLite itself. Indices are created once the rows are in, which is
+  #  faster than updating them row by row.
+  file_con.close()
+  db.execute("attach database ? as persistent", (persistent_path,))
+  schema = db.execute(
+    "select type, name, sql from persistent.sqlite_master"
+    " where sql is not null and name not like 'sqlite_%'"
+    " order by type = 'index'"
+  ).fetchall()
+  for type, name, sql in schema:
+    db.execute(sql)
+    if type == "table":
+      db.execute('insert into main."{0}" select * from persistent."{0}"'.format(name))
+  db.execute("PRAGMA user_version = {0}".format(SCHEMA_VERSION))
+  db.commit()
+  db.execute("detach database persistent")
+  return db
+
+
+def openOnDisk(persistent_path):
+  db = sqlite3.connect(persistent_path, check_same_thread=False)
+  # Readers do not block the writer in WAL mode, and a commit only has to
+  #  sync the log. Up to 64MiB of pages are cached, and the file is mapped
+  #  into memory for reading where possible.
+  db.execute("PRAGMA journal_mode=WAL")
+  db.execute("PRAGMA synchronous=NORMAL")
+  db.execute("PRAGMA cache_size=-65536")
+  db.execute("PRAGMA mmap_size=268435456")
+  db.execute("PRAGMA temp_store=MEMORY")
+  return db
+
+
+def getPreferredPathKey(preference="shortest", contentDirectories=()):
+  # Returns a key by which the paths to the same file are sorted, the path
+  #  to be given as the potential match sorting first. The preference is
+  #  one of:
+  #   shortest := the path with the fewest characters
+  #   alphabetical := the path sorting first alphabetically
+  #   contentDirectoryOrder := the path in the content directory listed
+  #     first, then the shortest path
+  if preference == "alphabetical":
+    return lambda path: path
+
+  elif preference == "contentDirectoryOrder":
+    contentDirectories = [os.path.abspath(d) for d in contentDirectories]
+    def key(path):
+      for i, d in enumerate(contentDirectories):
+        if path.startswith(d + os.sep):
+          return (i, len(path), path)
+      return (len(contentDirectories), len(path), path)
+    return key
+
+  else:
+    return lambda path: (len(path), path)
+
+
+def getSubtreeBounds(directory):
+  # Every path below a directory sorts between the directory followed by a
+  #  separator, and the directory followed by the character after the
+  #  separator. Unlike LIKE, this comparison is case sensitive, has no
+  #  wildcards, and does not match siblings sharing a prefix.
+  return (directory, directory + os.sep, directory + chr(ord(os.sep)+1))
+
+
+# The version of the schema below, kept in the user_version of the database.
+#  Version 0 is the schema before it was versioned, with every file in one
+#  warez table. Version 1 did not count the failures to read a file, and
+#  version 2 did not keep the device and inode of a file.
+SCHEMA_VERSION = 3
+
+# Files that could not be read this many times in a row are no longer given
+#  as potential matches, until they are found again by walking their
+#  directory.
+MAX_READ_FAILURES = 3
+
+SCHEMA = """
+  create table if not exists directories(
+    id integer PRIMARY KEY,
+    path text UNIQUE,
+    mtime real,
+    inode int
+  );
+  create table if not exists files(
+    dir_id int REFERENCES directories(id),
+    name text,
+    size int,
+    failures int NOT NULL DEFAULT 0,
+    device int,
+    inode int,
+    PRIMARY KEY (dir_id, name) ON CONFLICT REPLACE
+  ){0};
+  {1};
+"""
+
+# Holds every column read when looking up files by size, so that the
+#  lookup never has to read the table itself.
+FILES_BY_SIZE_INDEX = (
+  "create index if not exists files_by_size"
+  " on files(size, failures, dir_id, name, device, inode)"
+)
+
+# Files are stored in the b-tree of their primary key, rather than in a
+#  table with a separate index on its primary key, where SQLite supports it.
+if sqlite3.sqlite_version_info >= (3, 8, 2):
+  SCHEMA = SCHEMA.format(" WITHOUT ROWID", FILES_BY_SIZE_INDEX)
+else:
+  SCHEMA = SCHEMA.format("", FILES_BY_SIZE_INDEX)
+
+
+def ensureSchema(db):
+  # Creates the tables of an empty cache, or brings the tables of a cache
+  #  saved with an older schema up to date.
+  version = db.execute("PRAGMA user_version").fetchone()[0]
+  if version >= SCHEMA_VERSION:
+    return
+
+  tables = set(row[0] for row in db.execute(
+    "select name from sqlite_master where type = 'table'"
+  ))
+  if version >= 1:
+    upgradeSchema(db, version)
+    return
+
+  if "warez" in tables:
+    log.info("Migrating cache from schema version {0} to {1}".format(version, SCHEMA_VERSION))
+  if "directories" in tables:
+    # Directory states were kept by path alone.
+    db.execute("alter table directories rename to old_directories")
+
+  db.executescript(SCHEMA)
+
+  if "directories" in tables:
+    db.execute(
+      "insert into directories(path, mtime, inode)"
+      " select path, mtime, inode from old_directories"
+    )
+    db.execute("drop table old_directories")
 
+  if "warez" in tables:
+    db.execute(
+      "insert or ignore into directories(path)"
+      " select distinct absolute_path from warez"
+    )
+    db.execute(
+      "insert into files(dir_id, name, size)"
+      " select directories.id, warez.filename, warez.size"
+      " from warez join directories on directories.path = warez.absolute_path"
+    )
+    db.execute("drop table warez")
 
-def walkDirectoriesForFiles(*contentDirectories):
-  fileInfoFromContentDirectory = []
+  db.execute("PRAGMA user_version = {0}".format(SCHEMA_VERSION))
+  db.commit()
 
-  for contentDirectory in contentDirectories:
-    filesInContentDirectory = 0
-    log.info("Collecting all files in content directory => {0}".format(contentDirectory))
-    for root, dirs, files in os.walk(contentDirectory, onerror=errorEncounteredWhileWalking):
-      for f in files:
-        filesInContentDirectory += 1
-        filepath = os.path.join( os.path.abspath(root), f )
-      
-        if os.path.exists( filepath ):
-          filesize = os.path.getsize( filepath )
-          absolutePath = os.path.abspath( root )
-        
-          fileInfo = (absolutePath, f, filesize)
-          fileInfoFromContentDirectory.append( fileInfo )
+  if "warez" in tables:
+    # Give back the pages of the dropped table.
+    db.execute("VACUUM")
 
-        else:
-          log.warning("Problem with accessing file => {0}".format(filepath))
 
-  return fileInfoFromContentDirectory
+def upgradeSchema(db, version):
+  log.info("Upgrading cache from schema version {0} to {1}".format(version, SCHEMA_VERSION))
+  if version < 2:
+    db.execute("alter table files add column failures int NOT NULL DEFAULT 0")
+  if version < 3:
+    # Files are given a device and inode once they are walked again.
+    db.execute("alter table files add column device int")
+    db.execute("alter table files add column inode int")
 
+  db.execute("drop index if exists files_by_size")
+  db.execute(FILES_BY_SIZE_INDEX)
 
-def errorEncounteredWhileWalking( error ):
-  log.warning("Error accessing path: '{0}'".format(error.filename))
-  log.warning(error)
-  log.warning("To fix this problem, perhaps execute the following command:")
-  log.warning("# chmod -R +rx '{0}'".format(error.filename))
+  db.execute("PRAGMA user_version = {0}".format(SCHEMA_VERSION))
+  db.commit()
 
 
 class ContentDirectoryCache:
-  def __init__(self, save_to=None, db=None):
+  def __init__(self, save_to=None, db=None, scanThreadsPerDevice=1):
     log.debug("ContentDirectoryCache initialized.")
 
+    # The number of threads listing the directories stored on each device
+    #  while walking.
+    self.scanThreadsPerDevice = scanThreadsPerDevice
+
+    # The cache is refreshed in a thread while it is queried from others,
+    #  so the database connection is shared between threads and guarded by
+    #  a lock. The lock is only held while the database is used, never
+    #  while the content directories are walked.
+    self.lock = threading.Lock()
+
     # This class should either be instantiated with a pre-existing
     #  database, or nothing at all.
-    table_def = """
-      create table warez(
-        absolute_path text,
-        filename text,
-        size int,
-        PRIMARY KEY (absolute_path, filename) ON CONFLICT REPLACE
-      )
-    """
     if db is None:
         log.debug("No database passed in, new db to be created.")
-    	self.db = sqlite3.connect(":memory:")
-        cursor = self.db.cursor().execute(table_def)
-        self.db.commit()
-
-        # If a persistent path is provided, initialize the database
-        #  on disk.
-        if save_to is not None:
-          file_db = sqlite3.connect(save_to)
-          file_db.cursor().execute(table_def)
-          file_db.commit()
-          file_db.close()
+        self.db = sqlite3.connect(":memory:", check_same_thread=False)
 
     else:
        log.debug("Pre-existing database supplied upon instantiation.")
        self.db = db
 
     # Save the file path in which to persist this database to a file.
+    #  A cache queried on disk directly has no copy to save.
     self.persistent_path = save_to
 
+    ensureSchema(self.db)
+    if save_to is not None:
+      file_db = sqlite3.connect(save_to)
+      ensureSchema(file_db)
+      file_db.close()
+
 
   def getAllFilesOfSize(self, size):
-    cursor = self.db.cursor()
-    cursor.execute("select absolute_path, filename from warez where size = ?", (size,))
-    filesWithSpecifiedSize = cursor.fetchall()
-    
-    log.debug("Getting all files of size {0}B => {1}".format(size, len(filesWithSpecifiedSize)))
-    filenames = []
-    for fileInfoRow in filesWithSpecifiedSize:
-      fileDirectory = fileInfoRow[0]
-      filename = fileInfoRow[1]
+    return self.getAllFilesOfSizes([size])[size]
+
+
+  def getAllFilesOfSizes(self, sizes, preferredPathKey=None):
+    # Returns the paths of the files of each of the given sizes, keyed by
+    #  size. The sizes are looked up in one query, by joining a temporary
+    #  table of the sizes against the index of files by size. The cross
+    #  join keeps SQLite from scanning the whole index instead, since it
+    #  knows nothing of how few sizes the temporary table holds.
+    #
+    # Whether the files can be read is not checked here, but only once a
+    #  file is about to be read while matching. Files that failed to be
+    #  read too often are left out.
+    #
+    # Paths to the same file, through hard links or bind mounts, are given
+    #  as one potential match, so that the file is only read once. Of these
+    #  paths, the one sorting first by preferredPathKey is given.
+    with self.lock:
+      cursor = self.db.cursor()
+      cursor.execute("create temp table if not exists wanted_sizes(size int PRIMARY KEY)")
+      cursor.execute("delete from wanted_sizes")
+      cursor.executemany("insert or ignore into wanted_sizes values (?)", [(size,) for size in sizes])
+      cursor.execute(
+        "select wanted_sizes.size, directories.path, files.name, files.device, files.inode"
+        " from wanted_sizes"
+        " cross join files on files.size = wanted_sizes.size"
+        " join directories on directories.id = files.dir_id"
+        " where files.failures < ?",
+        (MAX_READ_FAILURES,)
+      )
+      filesWithSpecifiedSizes = cursor.fetchall()
+      cursor.execute("delete from wanted_sizes")
+      self.db.commit()
+
+    if preferredPathKey is None:
+      preferredPathKey = getPreferredPathKey()
+
+    linksToFiles = dict((size, {}) for size in sizes)
+    for size, fileDirectory, filename, device, inode in filesWithSpecifiedSizes:
       filepath = os.path.join(fileDirectory, filename)
 
-      if os.access(filepath, os.R_OK):
-        log.debug("  File added => {0}".format(filepath))
-        filenames.append( filepath )
+      # Files not yet walked with their device and inode are each their
+      #  own file.
+      if device is None:
+        identity = filepath
       else:
-        log.warning("  Cannot read file due to permissions error, ignoring: '{0}'".format(filepath))
-        log.warning("  To fix this problem, perhaps execute the following command:")
-        log.warning("   # chmod +r '{0}'".format(filepath))
-    
+        identity = (device, inode)
+      linksToFiles[size].setdefault(identity, []).append(filepath)
+
+    filenames = {}
+    for size, links in linksToFiles.items():
+      filenames[size] = sorted(min(paths, key=preferredPathKey) for paths in links.values())
+
+    log.debug("Getting all files of {0} sizes => {1} paths to {2} files".format(
+      len(filenames), len(filesWithSpecifiedSizes), sum(len(paths) for paths in filenames.values())
+    ))
     return filenames
 
 
+  def getPathsOfFile(self, size, device, inode):
+    # Returns the paths to the file stored at the given device and inode,
+    #  found among the files of its size.
+    with self.lock:
+      cursor = self.db.cursor()
+      cursor.execute(
+        "select directories.path, files.name"
+        " from files join directories on directories.id = files.dir_id"
+        " where files.size = ? and files.failures < ? and files.device = ? and files.inode = ?",
+        (size, MAX_READ_FAILURES, device, inode)
+      )
+      rows = cursor.fetchall()
+    return [os.path.join(fileDirectory, filename) for fileDirectory, filename in rows]
+
+
+  def getKnownFiles(self, files):
+    # Returns the set of the files, given by device, inode and size, that
+    #  are still in the cache.
+    knownFiles = set()
+    with self.lock:
+      cursor = self.db.cursor()
+      for device, inode, size in files:
+        cursor.execute(
+          "select 1 from files where size = ? and device = ? and inode = ? limit 1",
+          (size, device, inode)
+        )
+        if cursor.fetchone() is not None:
+          knownFiles.add((device, inode, size))
+    return knownFiles
+
+
+  def getFilesAfter(self, position, limit):
+    # Pages through every file in the cache in the order of its primary key.
+    #  Returns up to limit files following the given position, each as a
+    #  tuple of its position, its path and its size. A position of None
+    #  starts from the first file.
+    if position is None:
+      position = (-1, "")
+    with self.lock:
+      cursor = self.db.cursor()
+      cursor.execute(
+        "select files.dir_id, files.name, directories.path, files.size"
+        " from files join directories on directories.id = files.dir_id"
+        " where (files.dir_id > ? or (files.dir_id = ? and files.name > ?))"
+        " and files.failures < ?"
+        " order by files.dir_id, files.name limit ?",
+        (position[0], position[0], position[1], MAX_READ_FAILURES, limit)
+      )
+      rows = cursor.fetchall()
+    return [
+      ((dirId, filename), os.path.join(fileDirectory, filename), size)
+      for dirId, filename, fileDirectory, size in rows
+    ]
+
+
   def addDirectory(self, new_directory):
     # If a new directory is added that is a subdirectory of a content
     #  directory already added, then the directory will be walked, and
@@ -140,62 +388,245 @@ class ContentDirectoryCache:
     #  forceably update only one subdirectory of their content directory,
     #  all they need to to is add that subdirectory to the list of content
     #  directories.
-    log.debug("Adding {0} to cache".format(new_directory))
-    files = walkDirectoriesForFiles(new_directory)
+    self.addDirectories([new_directory])
 
-    if files:
-      log.debug("Inserting files into database")
-      self.db.executemany("insert into warez values (?,?,?)", files)
-      self.db.commit()
 
-      # Load the file backup with the newly added files.
-      self.add_files_to_persistent_db(files)
-    else:
+  def addDirectories(self, new_directories):
+    log.debug("Adding {0} to cache".format(", ".join(new_directories)))
+
+    # The files are written as the walk finds them, in chunks of one
+    #  transaction each, rather than collected first.
+    numberOfFiles = 0
+    files = []
+    directories = []
+    for kind, entry in walkDirectoryTrees(new_directories, self.scanThreadsPerDevice):
+      if kind == "file":
+        files.append(entry)
+      else:
+        directories.append(entry)
+
+      if len(files) + len(directories) >= WALK_CHUNK_SIZE:
+        numberOfFiles += len(files)
+        self.addFilesAndDirectoryStates(files, directories)
+        files = []
+        directories = []
+
+    numberOfFiles += len(files)
+    self.addFilesAndDirectoryStates(files, directories)
+
+    if numberOfFiles == 0 and new_directories:
       log.warning(
         "No files found in {0}. No potential matches will be possible from"
-        " this directory.".format(new_directory)
+        " this directory.".format(", ".join(new_directories))
       )
 
 
-  def add_files_to_persistent_db(self, files):
-    if self.persistent_path:
-        log.debug("Adding {0} files to persistent db copy at {1}".format(
-          len(files),
-          self.persistent_path
-        ))
-        file_con = sqlite3.connect(self.persistent_path)
-        file_con.executemany("insert into warez values (?,?,?)", files)
-        file_con.commit()
-        file_con.close()
+  def addFiles(self, files):
+    self.addFilesAndDirectoryStates(files, [])
+
+
+  def addFilesAndDirectoryStates(self, files, directories):
+    # Each file is given as a tuple of its absolute directory, its filename,
+    #  its size, and the device and inode it is stored at. A file already
+    #  in the cache is replaced, so that a change in its size is picked up.
+    #
+    # Each directory is given as a tuple of its absolute path, its
+    #  modification time and its inode. A directory keeps its id, along
+    #  with the files in it, when its state is updated.
+    #
+    # Directories are referred to by their path in every statement, never
+    #  by their id, so that the copy on disk is changed in the same way
+    #  as the cache in memory without having to know the ids.
+    log.debug("Inserting {0} files and {1} directories into database".format(
+      len(files), len(directories)
+    ))
+    directoryPaths = set(f[0] for f in files)
+    directoryPaths.update(d[0] for d in directories)
+    self.writeAll([
+      (
+        "insert or ignore into directories(path) values (?)",
+        [(path,) for path in directoryPaths]
+      ),
+      (
+        "update directories set mtime = ?, inode = ? where path = ?",
+        [(mtime, inode, path) for path, mtime, inode in directories]
+      ),
+      (
+        "insert into files(dir_id, name, size, device, inode)"
+        " select id, ?, ?, ?, ? from directories where path = ?",
+        [(filename, size, device, inode, directory) for directory, filename, size, device, inode in files]
+      ),
+    ])
+
+
+  def removeFiles(self, paths):
+    log.debug("Removing {0} files from cache".format(len(paths)))
+    self.write(
+      "DELETE from files where"
+      " dir_id = (select id from directories where path = ?) and name = ?",
+      [os.path.split(path) for path in paths]
+    )
 
 
-  def removeDirectory(self, dir_to_remove):
-    # Delete results from the database that have the directory to be removed
-    #  as a prefix of their absolute path.
-    log.debug("Removing {0} from cache".format(dir_to_remove))
-    c = self.db.cursor()
-    c.execute(
-      "DELETE from warez where absolute_path LIKE ?",
-      (dir_to_remove+'%',)
+  def markUnreadableFiles(self, paths):
+    # Counts one more failure to read each of the files. Adding a file to
+    #  the cache again starts its count over.
+    log.debug("Marking {0} files as unreadable in cache".format(len(paths)))
+    self.write(
+      "update files set failures = failures + 1 where"
+      " dir_id = (select id from directories where path = ?) and name = ?",
+      [os.path.split(path) for path in paths]
     )
-    self.db.commit()
-    log.debug("Removal of {0} complete".format(dir_to_remove))
 
-    self.remove_files_from_dir_in_persistent_db(dir_to_remove)
 
+  def setDirectoryStates(self, directories):
+    self.addFilesAndDirectoryStates([], directories)
 
-  def remove_files_from_dir_in_persistent_db(dir_to_remove):
-    if self.persistent_path:
-        log.debug("Removing all files in {0} from persistent db copy at {1}".format(
-          dir_to_remove,
-          self.persistent_path
-        ))
-        file_con = sqlite3.connect(self.persistent_path)
-        file_con.cursor().execute(
-          "DELETE from warez where absolute_path LIKE ?",
-          (dir_to_remove+'%',)
-        )
-        file_con.commit()
-        file_con.close()
-        log.debug("Removing complete for persistent db copy")
 
+  def getDirectoryStates(self, directory):
+    with self.lock:
+      cursor = self.db.cursor()
+      cursor.execute(
+        "select path, mtime, inode from directories"
+        " where path = ? or (path >= ? and path < ?)",
+        getSubtreeBounds(directory)
+      )
+      rows = cursor.fetchall()
+    return dict((row[0], (row[1], row[2])) for row in rows)
+
+
+  def getFilenamesInDirectory(self, directory):
+    with self.lock:
+      cursor = self.db.cursor()
+      cursor.execute(
+        "select files.name from files join directories on directories.id = files.dir_id"
+        " where directories.path = ?",
+        (directory,)
+      )
+      rows = cursor.fetchall()
+    return set(row[0] for row in rows)
+
+
+  def write(self, statement, rows):
+    self.writeAll([(statement, rows)])
+
+
+  def writeAll(self, statements):
+    # Every change to the cache in memory is made to the copy on disk as
+    #  well, so that the copy can be loaded on the next start. The
+    #  statements are run in one transaction on each.
+    with self.lock:
+      for statement, rows in statements:
+        self.db.executemany(statement, rows)
+      self.db.commit()
+
+      if self.persistent_path:
+          file_con = sqlite3.connect(self.persistent_path)
+          for statement, rows in statements:
+            file_con.executemany(statement, rows)
+          file_con.commit()
+          file_con.close()
+
+
+  def refresh(self, dirs):
+    # Bring the cache up to date with the content directories, listing only
+    #  the directories that changed since they were last walked.
+    unknownDirectories = []
+    for d in dirs:
+      d = os.path.abspath(d)
+      knownDirectories = self.getDirectoryStates(d)
+      if knownDirectories:
+        log.info("Refreshing {0} in cache".format(d))
+        self.refreshChangedDirectories(d, knownDirectories)
+
+      else:
+        # The directory was cached before directory states were kept, or
+        #  is not cached at all, so it is walked in full.
+        log.info("Walking {0} for cache".format(d))
+        self.removeDirectory(d)
+        unknownDirectories.append(d)
+
+    if unknownDirectories:
+      self.addDirectories(unknownDirectories)
+
+
+  def refreshChangedDirectories(self, contentDirectory, knownDirectories):
+    # A directory whose modification time and inode are unchanged still has
+    #  the same entries, so it is not listed again. Its known subdirectories
+    #  are still visited, since a change further down the tree does not
+    #  change the modification time of the directory. Files written to in
+    #  place are not noticed, as they do not change their directory either.
+    knownSubdirectories = {}
+    for path in knownDirectories:
+      knownSubdirectories.setdefault(os.path.dirname(path), []).append(path)
+
+    changedFiles = []
+    removedFiles = []
+    removedDirectories = []
+    changedDirectories = []
+
+    unvisited = [contentDirectory]
+    while unvisited:
+      directory = unvisited.pop()
+      try:
+        # Stat the directory before listing it, so that an entry created
+        #  while listing leaves the directory looking changed next time.
+        directoryState = getDirectoryState(directory)
+      except OSError:
+        removedDirectories.append(directory)
+        continue
+
+      if knownDirectories.get(directory) == directoryState[1:]:
+        unvisited.extend(knownSubdirectories.get(directory, []))
+        continue
+
+      filenames = set()
+      subdirectories = set()
+      try:
+        for filename, status in scanDirectory(directory):
+          if status is None:
+            subdirectories.add(os.path.join(directory, filename))
+          else:
+            filenames.add(filename)
+            changedFiles.append((directory, filename, status.st_size, status.st_dev, status.st_ino))
+      except OSError as e:
+        errorEncounteredWhileWalking(e)
+        continue
+
+      for filename in self.getFilenamesInDirectory(directory) - filenames:
+        removedFiles.append(os.path.join(directory, filename))
+      for subdirectory in knownSubdirectories.get(directory, []):
+        if subdirectory not in subdirectories:
+          removedDirectories.append(subdirectory)
+
+      unvisited.extend(subdirectories)
+      changedDirectories.append(directoryState)
+
+    log.debug("{0} of {1} directories in {2} changed".format(
+      len(changedDirectories), len(knownDirectories), contentDirectory
+    ))
+    for directory in removedDirectories:
+      self.removeDirectory(directory)
+    if removedFiles:
+      self.removeFiles(removedFiles)
+    if changedFiles:
+      self.addFiles(changedFiles)
+    self.setDirectoryStates(changedDirectories)
+
+
+  def removeDirectory(self, dir_to_remove):
+    # Delete results from the database that are in the directory to be
+    #  removed, or in any directory below it.
+    log.debug("Removing {0} from cache".format(dir_to_remove))
+    dir_to_remove = os.path.abspath(dir_to_remove)
+    bounds = getSubtreeBounds(dir_to_remove)
+    self.write(
+      "DELETE from files where dir_id in (select id from directories"
+      " where path = ? or (path >= ? and path < ?))",
+      [bounds]
+    )
+    self.write(
+      "DELETE from directories where path = ? or (path >= ? and path < ?)",
+      [bounds]
+    )
+    log.debug("Removal of {0} complete".format(dir_to_remove))
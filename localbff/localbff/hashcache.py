@@ -0,0 +1,185 @@
+import sqlite3
+import logging
+import os
+import threading
+
+log = logging.getLogger(__name__)
+
+# The number of rows checked at once when the cache is pruned, so that the
+#  lock is never held for long.
+PRUNE_BATCH_SIZE = 1000
+
+
+def load(persistent_path=None):
+  if persistent_path:
+    log.debug("Loading piece hash cache from {0}".format(persistent_path))
+    return PieceHashCache(db=sqlite3.connect(persistent_path, check_same_thread=False))
+  else:
+    log.debug("No path for the piece hash cache, keeping it in memory.")
+    return PieceHashCache()
+
+
+def getFileIdentity(path):
+  # A file is considered unchanged for as long as it lives on the same
+  #  device and inode, and has the same size and modification time.
+  status = os.stat(path)
+  return (status.st_dev, status.st_ino, status.st_size, status.st_mtime)
+
+
+class PieceHashCache:
+  """Maps a byte range of a file on disk to the SHA1 of that byte range.
+  Since the same library files are checked against many metafiles, a hash
+  computed once can be reused instead of reading the file again. The root of
+  the merkle tree of a whole file, which a v2 metafile gives for each of its
+  files, is kept as well.
+
+  Several metafiles may be matched at once on different threads, so the
+  database connection is shared between threads and guarded by a lock."""
+  def __init__(self, db=None):
+    if db is None:
+      db = sqlite3.connect(":memory:", check_same_thread=False)
+
+    self.db = db
+    self.lock = threading.Lock()
+    self.db.execute("""
+      create table if not exists hashes(
+        device int,
+        inode int,
+        size int,
+        mtime real,
+        offset int,
+        length int,
+        sha1 blob,
+        PRIMARY KEY (device, inode, size, mtime, offset, length) ON CONFLICT REPLACE
+      )
+    """)
+    # Files are found by the hash of a byte range as well, such as the
+    #  first piece of a metafile.
+    self.db.execute("create index if not exists hashes_by_sha1 on hashes(sha1)")
+    self.db.execute("""
+      create table if not exists roots(
+        device int,
+        inode int,
+        size int,
+        mtime real,
+        root blob,
+        PRIMARY KEY (device, inode, size, mtime) ON CONFLICT REPLACE
+      )
+    """)
+    self.db.execute("create index if not exists roots_by_root on roots(root)")
+    self.db.commit()
+
+
+  def lookup(self, identity, offset, length):
+    with self.lock:
+      cursor = self.db.cursor()
+      cursor.execute(
+        "select sha1 from hashes where device = ? and inode = ? and size = ?"
+        " and mtime = ? and offset = ? and length = ?",
+        identity + (offset, length)
+      )
+      row = cursor.fetchone()
+    if row is None:
+      return None
+    return bytes(row[0])
+
+
+  def findIdentities(self, digest, offset, length):
+    # Returns the identities of the files having the given hash for the
+    #  given byte range.
+    with self.lock:
+      cursor = self.db.cursor()
+      cursor.execute(
+        "select device, inode, size, mtime from hashes"
+        " where sha1 = ? and offset = ? and length = ?",
+        (sqlite3.Binary(digest), offset, length)
+      )
+      return [tuple(row) for row in cursor.fetchall()]
+
+
+  def lookupRoot(self, identity):
+    with self.lock:
+      cursor = self.db.cursor()
+      cursor.execute(
+        "select root from roots where device = ? and inode = ? and size = ?"
+        " and mtime = ?",
+        identity
+      )
+      row = cursor.fetchone()
+    if row is None:
+      return None
+    return bytes(row[0])
+
+
+  def findIdentitiesByRoot(self, root):
+    with self.lock:
+      cursor = self.db.cursor()
+      cursor.execute(
+        "select device, inode, size, mtime from roots where root = ?",
+        (sqlite3.Binary(root),)
+      )
+      return [tuple(row) for row in cursor.fetchall()]
+
+
+  def storeRoot(self, identity, root):
+    with self.lock:
+      self.db.execute(
+        "insert into roots values (?,?,?,?,?)",
+        identity + (sqlite3.Binary(root),)
+      )
+
+
+  def store(self, identity, offset, length, digest):
+    with self.lock:
+      self.db.execute(
+        "insert into hashes values (?,?,?,?,?,?,?)",
+        identity + (offset, length, sqlite3.Binary(digest))
+      )
+
+
+  def prune(self, getKnownFiles):
+    # Deletes the hashes and roots of the files that are no longer in the
+    #  content directories, and those of earlier versions of the files
+    #  that are. getKnownFiles is given a list of files, by device, inode
+    #  and size, and returns the set of those that are still there. Each
+    #  table is paged through by rowid, a batch of rows at a time.
+    for table in ("hashes", "roots"):
+      position = 0
+      while True:
+        with self.lock:
+          cursor = self.db.cursor()
+          cursor.execute(
+            "select rowid, device, inode, size from {0}"
+            " where rowid > ? order by rowid limit ?".format(table),
+            (position, PRUNE_BATCH_SIZE)
+          )
+          rows = cursor.fetchall()
+        if not rows:
+          break
+        position = rows[-1][0]
+
+        files = list(set(tuple(row[1:]) for row in rows))
+        knownFiles = getKnownFiles(files)
+        with self.lock:
+          self.db.executemany(
+            "delete from {0} where device = ? and inode = ? and size = ?".format(table),
+            [f for f in files if f not in knownFiles]
+          )
+          self.db.executemany(
+            "delete from {0} where device = ? and inode = ? and size = ? and mtime <"
+            " (select max(mtime) from {0} as newest where newest.device = ?"
+            "  and newest.inode = ? and newest.size = ?)".format(table),
+            [f + f for f in files if f in knownFiles]
+          )
+          self.db.commit()
+
+
+  def commit(self):
+    with self.lock:
+      self.db.commit()
+
+
+  def close(self):
+    with self.lock:
+      self.db.commit()
+      self.db.close()
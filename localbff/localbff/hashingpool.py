@@ -0,0 +1,125 @@
+import threading
+import Queue
+import logging
+from hashlib import sha1
+from hashcache import getFileIdentity
+from readers import BufferedReader
+
+log = logging.getLogger(__name__)
+
+
+class PendingDigest:
+  def __init__(self, identity=None):
+    self.identity = identity
+    self.digest = None
+    self.error = None
+    self.isFromHashCache = False
+    self.done = threading.Event()
+
+  def setDigest(self, digest):
+    self.digest = digest
+    self.done.set()
+
+  def setError(self, error):
+    self.error = error
+    self.done.set()
+
+  def wait(self):
+    self.done.wait()
+    if self.error is not None:
+      raise self.error
+    return self.digest
+
+
+class PieceHashingPool:
+  """Reads and hashes byte ranges of possible matches on a pool of worker
+  threads. Ranges are submitted ahead of the piece that needs them, and the
+  piece later collects the digest on the thread doing the matching, so the
+  order in which pieces are matched does not depend on the worker threads.
+
+  Each worker reads into a buffer of its own, allocated once, so the memory
+  used for buffers is bounded by the number of threads times the largest
+  range submitted. Python's hashlib releases the GIL while hashing large
+  buffers, so the workers hash concurrently."""
+  def __init__(self, numberOfThreads, hashCache=None, bufferSize=0, reader=None):
+    self.hashCache = hashCache
+    self.bufferSize = bufferSize
+    if reader is None:
+      reader = BufferedReader()
+    self.reader = reader
+    self.pendingDigests = {}
+    self.jobs = Queue.Queue()
+
+    log.debug("Starting {0} hashing threads".format(numberOfThreads))
+    self.threads = []
+    for i in range(numberOfThreads):
+      thread = threading.Thread(target=self.hashSubmittedRanges, name="localbff-hashing-{0}".format(i))
+      thread.daemon = True
+      thread.start()
+      self.threads.append(thread)
+
+
+  def submit(self, path, offset, length, padding=0):
+    # The range is followed by as many zeros as given by padding, for the
+    #  pad files following the end of a file.
+    key = (path, offset, length, padding)
+    if key in self.pendingDigests:
+      return
+
+    # The hash cache is only touched from the thread doing the matching,
+    #  so the workers never wait on its lock.
+    pendingDigest = PendingDigest()
+    self.pendingDigests[key] = pendingDigest
+    if self.hashCache is not None:
+      try:
+        pendingDigest.identity = getFileIdentity(path)
+      except OSError as e:
+        pendingDigest.setError(e)
+        return
+
+      digest = self.hashCache.lookup(pendingDigest.identity, offset, length + padding)
+      if digest is not None:
+        pendingDigest.isFromHashCache = True
+        pendingDigest.setDigest(digest)
+        return
+
+    self.jobs.put((key, pendingDigest))
+
+
+  def getDigest(self, path, offset, length, padding=0):
+    key = (path, offset, length, padding)
+    if key not in self.pendingDigests:
+      self.submit(path, offset, length, padding)
+
+    pendingDigest = self.pendingDigests.pop(key)
+    digest = pendingDigest.wait()
+    if self.hashCache is not None and not pendingDigest.isFromHashCache:
+      self.hashCache.store(pendingDigest.identity, offset, length + padding, digest)
+    return digest
+
+
+  def hashSubmittedRanges(self):
+    buffer = bytearray(self.bufferSize)
+    while True:
+      job = self.jobs.get()
+      if job is None:
+        return
+
+      (path, offset, length, padding), pendingDigest = job
+      if len(buffer) < length + padding:
+        buffer = bytearray(length + padding)
+      try:
+        data = self.reader.read(path, offset, length, padding, buffer, readOnce=True)
+        pendingDigest.setDigest(sha1(data).digest())
+      except Exception as e:
+        # Raised again on the thread collecting the digest, so that the
+        #  worker goes on, and the piece waiting on it is not left waiting.
+        pendingDigest.setError(e)
+
+
+  def close(self):
+    for thread in self.threads:
+      self.jobs.put(None)
+    for thread in self.threads:
+      thread.join()
+    self.pendingDigests.clear()
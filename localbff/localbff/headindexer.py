@@ -0,0 +1,91 @@
+import time
+import logging
+from hashlib import sha1
+from hashcache import getFileIdentity
+from readers import adviseKernel, POSIX_FADV_DONTNEED
+
+log = logging.getLogger(__name__)
+
+# The piece lengths commonly chosen for metafiles, from 256KiB to 16MiB.
+HEAD_PIECE_LENGTHS = [2**i for i in range(18, 25)]
+
+
+def getHeadLengths(size):
+  # The first piece of a metafile whose first file has the given size, for
+  #  each of the common piece lengths. A file shorter than the piece length
+  #  fills the first piece of a single-file metafile on its own.
+  return sorted(set(min(pieceLength, size) for pieceLength in HEAD_PIECE_LENGTHS))
+
+
+class HeadHashIndexer:
+  """Hashes the beginning of library files in the background, and keeps the
+  hashes in the hash cache. The first piece of a single-file metafile, or of
+  a metafile whose first file is at least a piece long, is then found by the
+  hash cache's index of hashes, rather than by hashing every file of the
+  same size.
+
+  The hashes for all of the common piece lengths are computed from one read
+  of the first 16MiB of a file. Reading is throttled to bytesPerSecond, and
+  with dropReadRanges, what has been read is dropped from the page cache."""
+  def __init__(self, hashCache, bytesPerSecond, dropReadRanges=False):
+    self.hashCache = hashCache
+    self.bytesPerSecond = bytesPerSecond
+    self.dropReadRanges = dropReadRanges
+    self.isStopped = False
+
+
+  def stop(self):
+    """May be called from another thread than the one indexing."""
+    self.isStopped = True
+
+
+  def indexFiles(self, files):
+    # Each file is given as a tuple of its path and its size.
+    startTime = time.time()
+    bytesRead = 0
+    for path, size in files:
+      if self.isStopped:
+        break
+      bytesRead += self.indexFile(path)
+
+      # Wait for as long as reading the bytes read so far should take.
+      ahead = float(bytesRead)/self.bytesPerSecond - (time.time() - startTime)
+      if ahead > 0:
+        time.sleep(ahead)
+
+    self.hashCache.commit()
+
+
+  def indexFile(self, path):
+    # Returns the number of bytes read.
+    try:
+      identity = getFileIdentity(path)
+    except OSError:
+      return 0
+
+    size = identity[2]
+    if size == 0:
+      return 0
+    headLengths = getHeadLengths(size)
+    if self.hashCache.lookup(identity, 0, headLengths[-1]) is not None:
+      # Indexed before, and unchanged since.
+      return 0
+
+    log.debug("Indexing head of {0}".format(path))
+    headHash = sha1()
+    bytesRead = 0
+    try:
+      with open(path, 'rb') as f:
+        for headLength in headLengths:
+          data = f.read(headLength - bytesRead)
+          bytesRead += len(data)
+          if bytesRead < headLength:
+            # Shortened since it was stat'ed.
+            break
+          headHash.update(data)
+          self.hashCache.store(identity, 0, headLength, headHash.digest())
+        if self.dropReadRanges:
+          adviseKernel(f.fileno(), 0, bytesRead, POSIX_FADV_DONTNEED)
+    except (IOError, OSError) as e:
+      log.debug("Cannot index {0}: {1}".format(path, e))
+    return bytesRead
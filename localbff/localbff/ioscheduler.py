@@ -0,0 +1,281 @@
+import os
+import time
+import threading
+import logging
+from collections import deque
+
+log = logging.getLogger(__name__)
+
+# The throughput of a device is the number of bytes read from it over this
+#  many seconds.
+THROUGHPUT_WINDOW = 10
+
+# A file read from start to end gives up its slot every this many bytes,
+#  so that other reads of the same device are not held up for the whole
+#  file.
+TURN_SIZE = 8*1024*1024
+
+# Seconds between checks of whether a search waiting for a slot has been
+#  cancelled.
+CANCEL_CHECK_INTERVAL = 1.0
+
+
+class ReadCancelled(Exception):
+  """Raised instead of handing out a slot to a search cancelled while it
+  was waiting for one."""
+
+
+def isRotational(device):
+  # Linux tells whether the disk holding a device spins. A partition is a
+  #  directory below its disk, which has the queue. Devices with no disk of
+  #  their own, such as network mounts, and every device elsewhere than on
+  #  Linux, are taken to be spinning, so that they are read one at a time.
+  devicePath = '/sys/dev/block/{0}:{1}'.format(os.major(device), os.minor(device))
+  for queuePath in (devicePath, os.path.join(devicePath, '..')):
+    try:
+      with open(os.path.join(queuePath, 'queue', 'rotational')) as f:
+        return f.read().strip() != '0'
+    except IOError:
+      continue
+  return True
+
+
+class DeviceQueue:
+  """Hands out the slots for reading from one device, first come, first
+  served, to at most concurrency readers at a time, and holds their reads
+  to bytesPerSecond, if given. Counts what is read."""
+  def __init__(self, device, isRotational, concurrency, bytesPerSecond=0):
+    self.device = device
+    self.isRotational = isRotational
+    self.concurrency = concurrency
+    self.bytesPerSecond = bytesPerSecond
+    self.condition = threading.Condition()
+
+    self.waiting = deque()
+    self.active = 0
+
+    # The allowance is spent on every read, and refills at bytesPerSecond
+    #  up to a second's worth. A read larger than what is left is made,
+    #  and the next one waits until the allowance is paid back.
+    self.allowance = bytesPerSecond
+    self.allowanceTime = time.time()
+
+    self.reads = 0
+    self.bytesRead = 0
+    self.waitTime = 0.0
+    self.readTime = 0.0
+    self.recentReads = deque()
+
+
+  def acquire(self, isCancelled=None):
+    # Raises ReadCancelled if isCancelled() turns true while waiting.
+    with self.condition:
+      waiter = object()
+      self.waiting.append(waiter)
+      startTime = time.time()
+      try:
+        while self.waiting[0] is not waiter or self.active >= self.concurrency:
+          if isCancelled is not None and isCancelled():
+            raise ReadCancelled()
+          self.condition.wait(CANCEL_CHECK_INTERVAL)
+      finally:
+        self.waiting.remove(waiter)
+        self.waitTime += time.time() - startTime
+        # The next reader in line may fit as well, or be first now.
+        self.condition.notify_all()
+      self.active += 1
+
+
+  def release(self):
+    with self.condition:
+      self.active -= 1
+      self.condition.notify_all()
+
+
+  def setLimits(self, concurrency, bytesPerSecond):
+    with self.condition:
+      self.concurrency = concurrency
+      self.bytesPerSecond = bytesPerSecond
+      self.allowance = min(self.allowance, bytesPerSecond)
+      self.condition.notify_all()
+
+
+  def throttle(self, length):
+    # Called with a slot held, before reading length bytes.
+    with self.condition:
+      if not self.bytesPerSecond:
+        return
+      now = time.time()
+      self.allowance = min(
+        self.bytesPerSecond,
+        self.allowance + (now - self.allowanceTime)*self.bytesPerSecond
+      )
+      self.allowanceTime = now
+      self.allowance -= length
+      delay = -self.allowance/float(self.bytesPerSecond)
+    if delay > 0:
+      time.sleep(delay)
+
+
+  def countRead(self, length, seconds):
+    with self.condition:
+      now = time.time()
+      self.reads += 1
+      self.bytesRead += length
+      self.readTime += seconds
+      self.recentReads.append((now, length))
+      self.forgetOldReads(now)
+
+
+  def forgetOldReads(self, now):
+    while self.recentReads and now - self.recentReads[0][0] > THROUGHPUT_WINDOW:
+      self.recentReads.popleft()
+
+
+  def getStats(self):
+    with self.condition:
+      self.forgetOldReads(time.time())
+      return {
+        "device": "{0}:{1}".format(os.major(self.device), os.minor(self.device)),
+        "rotational": self.isRotational,
+        "concurrency": self.concurrency,
+        "bytes_per_second_limit": self.bytesPerSecond,
+        "queue_depth": len(self.waiting),
+        "active_reads": self.active,
+        "reads": self.reads,
+        "bytes_read": self.bytesRead,
+        "wait_time": self.waitTime,
+        "read_time": self.readTime,
+        "throughput": sum(length for t, length in self.recentReads)/float(THROUGHPUT_WINDOW),
+      }
+
+
+class IOScheduler:
+  """Queues the reads of possible matches by the device they are stored on
+  (st_dev), so that verifying several pieces, or several metafiles, at once
+  does not interleave reads on one spinning disk while the others sit idle.
+
+  A spinning disk is read by rotationalConcurrency readers at a time, and
+  any other device by solidStateConcurrency. With bytesPerSecond, reading
+  from each device is held to that rate, leaving the rest of the disk to
+  the torrents being seeded from it. One scheduler is shared by all of the
+  searches running at once."""
+  def __init__(self, rotationalConcurrency=1, solidStateConcurrency=4, bytesPerSecond=0):
+    self.rotationalConcurrency = rotationalConcurrency
+    self.solidStateConcurrency = solidStateConcurrency
+    self.bytesPerSecond = bytesPerSecond
+    self.deviceQueues = {}
+    self.lock = threading.Lock()
+
+
+  def setLimits(self, rotationalConcurrency, solidStateConcurrency, bytesPerSecond):
+    with self.lock:
+      self.rotationalConcurrency = rotationalConcurrency
+      self.solidStateConcurrency = solidStateConcurrency
+      self.bytesPerSecond = bytesPerSecond
+      for deviceQueue in self.deviceQueues.values():
+        deviceQueue.setLimits(self.getConcurrency(deviceQueue.isRotational), bytesPerSecond)
+
+
+  def getConcurrency(self, isRotational):
+    if isRotational:
+      return max(1, self.rotationalConcurrency)
+    return max(1, self.solidStateConcurrency)
+
+
+  def acquire(self, device, isCancelled=None):
+    # Waits for a slot on the device (st_dev), and returns the queue of the
+    #  device, to be released once done reading.
+    deviceQueue = self.getDeviceQueue(device)
+    deviceQueue.acquire(isCancelled)
+    return deviceQueue
+
+
+  def getDeviceQueue(self, device):
+    with self.lock:
+      deviceQueue = self.deviceQueues.get(device)
+      if deviceQueue is None:
+        rotational = isRotational(device)
+        deviceQueue = DeviceQueue(device, rotational, self.getConcurrency(rotational), self.bytesPerSecond)
+        log.debug("Reading device {0} by {1} readers at a time".format(device, deviceQueue.concurrency))
+        self.deviceQueues[device] = deviceQueue
+      return deviceQueue
+
+
+  def getStats(self):
+    with self.lock:
+      deviceQueues = self.deviceQueues.values()
+    return sorted(
+      (deviceQueue.getStats() for deviceQueue in deviceQueues),
+      key=lambda stats: stats["device"]
+    )
+
+
+class ScheduledStream:
+  """Reads one file of a device from start to end, through an I/O
+  scheduler. The slot of the device is taken before a read, and given up
+  once turnSize bytes have been read in it, so that other reads of the
+  device take their turn in between."""
+  def __init__(self, ioScheduler, device, isCancelled=None, turnSize=TURN_SIZE):
+    self.deviceQueue = ioScheduler.getDeviceQueue(device)
+    self.isCancelled = isCancelled
+    self.turnSize = turnSize
+    self.hasSlot = False
+    self.bytesReadInTurn = 0
+
+
+  def beforeRead(self, length):
+    if not self.hasSlot:
+      self.deviceQueue.acquire(self.isCancelled)
+      self.hasSlot = True
+      self.bytesReadInTurn = 0
+    self.deviceQueue.throttle(length)
+
+
+  def afterRead(self, length, seconds):
+    self.deviceQueue.countRead(length, seconds)
+    self.bytesReadInTurn += length
+    if self.bytesReadInTurn >= self.turnSize:
+      self.close()
+
+
+  def close(self):
+    if self.hasSlot:
+      self.hasSlot = False
+      self.deviceQueue.release()
+
+
+class ScheduledReader:
+  """Makes the reads of another reader through an I/O scheduler. A mapped
+  file is only read as its slices are hashed, after its slot is released,
+  so the mmap reader is counted and throttled, but not queued, by what it
+  hands out.
+
+  The device of each path is looked up once, rather than on every read."""
+  def __init__(self, reader, ioScheduler, isCancelled=None):
+    self.reader = reader
+    self.ioScheduler = ioScheduler
+    self.isCancelled = isCancelled
+    self.devices = {}
+
+
+  def read(self, path, offset, length, padding, buffer, readOnce=False):
+    device = self.devices.get(path)
+    if device is None:
+      device = os.stat(path).st_dev
+      self.devices[path] = device
+
+    deviceQueue = self.ioScheduler.acquire(device, self.isCancelled)
+    try:
+      deviceQueue.throttle(length)
+      startTime = time.time()
+      data = self.reader.read(path, offset, length, padding, buffer, readOnce)
+      deviceQueue.countRead(min(len(data), length), time.time() - startTime)
+      return data
+    finally:
+      deviceQueue.release()
+
+
+  def close(self):
+    self.devices.clear()
+    self.reader.close()
@@ -1,20 +1,89 @@
+import io
 import os
+import time
+import random
 import logging
+from hashlib import sha1
+from collections import deque
+from hashingpool import PieceHashingPool
+from statcache import StatCache
+from hashcache import PieceHashCache, getFileIdentity
+from merkle import getPiecesRoot
+from buffers import readRange
+from readers import getReader, adviseKernel, POSIX_FADV_SEQUENTIAL, POSIX_FADV_DONTNEED
+from ioscheduler import ScheduledReader, ScheduledStream, ReadCancelled, TURN_SIZE
 log = logging.getLogger(__name__)
 
+# Possible matches streamed from start to end are read through a buffer of
+#  this size, so that the pieces of a small piece length are read from the
+#  disk several at a time.
+STREAM_BUFFER_SIZE = 8*1024*1024
+
 class LocalBitTorrentFileFinder:
-  def __init__(self, metafile=None, fastVerification=False):
+  def __init__(self, metafile=None, fastVerification=False, hashCache=None, numberOfThreads=1, memoryLimit=64*1024*1024, statCache=None, sequentialReads=False, reader="buffered", dropReadRanges=False, ioScheduler=None):
     # There are two ways of veriying if a potential match is a postive match:
     #  Thorough := check all piece hashes that contribute to a file
     #  Fast := check only one piece hash that contributes to a file.
     self.doFastVerification = fastVerification
 
+    # Hashes of pieces lying wholly inside of one file are remembered in
+    #  the hash cache, if one is given, so that unchanged files need not be
+    #  read again.
+    self.hashCache = hashCache
+
+    # In thorough verification, every piece lying inside of a file is read
+    #  from every possible match of the file. With sequential reads, each
+    #  possible match is instead streamed once, from its first such piece
+    #  to its last, through one open file, before any piece is matched. The
+    #  digests are kept in the hash cache, and the pieces are then matched
+    #  from it. Without a hash cache, one is kept in memory for the search.
+    self.doSequentialReads = sequentialReads and not fastVerification
+    if self.doSequentialReads and self.hashCache is None:
+      self.hashCache = PieceHashCache()
+
+    # Pieces may be read and hashed by several threads at once. Every
+    #  thread holds one piece in memory, so no more threads are started
+    #  than there are pieces fitting into the memory limit.
+    self.numberOfThreads = numberOfThreads
+    self.memoryLimit = memoryLimit
+
+    # Whether a possible match can be read is only checked once the
+    #  possible match is about to be read, since most possible matches of
+    #  a common size are eliminated without ever being opened. Those that
+    #  cannot be read are remembered, so that they can be skipped by later
+    #  searches for possible matches.
+    if statCache is None:
+      statCache = StatCache()
+    self.statCache = statCache
+    self.unreadablePaths = set()
+    self.checkedFiles = set()
+
     log.info("LocalBitTorrentFileFinder initialized")
     log.info("  Fast verification => {0}".format(fastVerification))
+    log.info("  Hashing threads => {0}".format(numberOfThreads))
+    log.info("  Sequential reads => {0}".format(self.doSequentialReads))
+    log.info("  Reader => {0}".format(reader))
     
     self.metafile = metafile
+
+    # Ranges of possible matches are read by a reader suiting the storage
+    #  they are on: "buffered", "mmap" or "direct". With dropReadRanges,
+    #  ranges that are only read once are dropped from the page cache once
+    #  hashed, so that matching does not push out the pieces being seeded.
+    self.dropReadRanges = dropReadRanges
+    self.reader = getReader(reader, dropReadRanges)
+
+    # With an I/O scheduler, possible matches are read in turns with the
+    #  other reads of the device they are on, which may be shared with
+    #  other searches running at once.
+    self.ioScheduler = ioScheduler
+    if ioScheduler is not None:
+      self.reader = ScheduledReader(self.reader, ioScheduler, self.hasBeenCancelled)
+    if metafile is not None:
+      metafile.pieces.reader = self.reader
     self.files = None
     self.percentageMatched = 0.0
+    self.isCancelled = False
 
 
   def connectPayloadFileToPotentialMatches(self, fileIndex, potentialMatches):
@@ -24,6 +93,9 @@ class LocalBitTorrentFileFinder:
 
     payloadFile = self.files[fileIndex]
     log.info("For {0}".format(payloadFile))
+    if payloadFile.isPadFile:
+      log.info("  Pad file, not matched")
+      return
     payloadFile.possibleMatches = potentialMatches
       
     log.info("  Number of Possible matches => {0}".format(len(payloadFile.possibleMatches)))
@@ -34,16 +106,18 @@ class LocalBitTorrentFileFinder:
  
   def positivelyMatchFilesInMetafileToPossibleMatches(self):
     log.info("Matching files in the file system to files in metafile")
-    
-    for piece in self.metafile.pieces:
-      piece.findMatch(fastVerification=self.doFastVerification)
-      if piece.isVerified:
-        newPercentageAdded = (float(piece.size)/self.metafile.payloadSize)*100
-        log.debug("Updating percentage stats => +" + str(newPercentageAdded) + "%")
-        self.percentageMatched += newPercentageAdded
-      log.debug("~"*80)
+
+    try:
+      self.matchFiles()
+    except ReadCancelled:
+      log.info("Matching cancelled while waiting to read")
+
     log.info("Percentage of Metafile matched => " + str(self.percentageMatched) + "%")
 
+    if self.hashCache is not None:
+      self.hashCache.commit()
+    self.reader.close()
+
     for file in self.files:
       log.info("FILE METADATA => " + file.getPathFromMetafile())
       log.info(" STATUS       => " + file.status)
@@ -51,6 +125,367 @@ class LocalBitTorrentFileFinder:
         log.info(" MATCH PATH   => " + file.getMatchedPathFromContentDirectory())
 
 
+  def matchFiles(self):
+    # The files of a v2 or hybrid metafile are first matched on their own,
+    #  against the root of their merkle trees. In a hybrid metafile, the v1
+    #  pieces produced by files matched this way are then trusted in fast
+    #  verification, as for any other positively matched file.
+    for payloadFile in self.files:
+      if self.isCancelled:
+        break
+      if payloadFile.piecesRoot is not None and payloadFile.possibleMatches:
+        self.matchFileByPiecesRoot(payloadFile)
+    
+    if self.doSequentialReads:
+      self.streamPossibleMatches()
+
+    # Pieces that lie wholly inside of one file are checked first. Each
+    #  possible match that cannot produce such a piece is eliminated, so
+    #  that it is never tried again in a combination with other files.
+    piecesSpanningFiles = []
+    piecesInsideOneFile = self.separatePiecesSpanningFiles(piecesSpanningFiles)
+
+    numberOfThreads = min(self.numberOfThreads, self.memoryLimit // self.metafile.pieceSize)
+    if numberOfThreads > 1:
+      hashingPool = PieceHashingPool(numberOfThreads, self.hashCache, self.metafile.pieceSize, self.reader)
+      try:
+        self.verifyPiecesReadingAhead(piecesInsideOneFile, hashingPool, 2*numberOfThreads)
+      finally:
+        hashingPool.close()
+    else:
+      for piece in piecesInsideOneFile:
+        self.verifyPiece(piece)
+
+    # The pieces spanning several files are then checked against the
+    #  reduced possible matches, fewest combinations first. Every match
+    #  found fixes the path of its files, which in turn shrinks the
+    #  combinations left for the neighbouring pieces.
+    piecesSpanningFiles.sort(
+      key=lambda p: p.contributingFiles.getCardinalityOfCartesianProductOfAllPossibleCombinations()
+    )
+    log.debug("{0} pieces span more than one file".format(len(piecesSpanningFiles)))
+    for piece in piecesSpanningFiles:
+      if self.isCancelled:
+        break
+      self.verifyPiece(piece)
+
+
+  def matchFileByPiecesRoot(self, payloadFile):
+    # Every possible match is stat'ed, and one indexed lookup gives those of
+    #  them whose root was computed before, for any metafile. Only when none
+    #  of those has the wanted root are the others read and hashed.
+    possibleMatches = []
+    for path in payloadFile.possibleMatches:
+      try:
+        possibleMatches.append((path, getFileIdentity(path)))
+      except OSError as e:
+        log.warning("Cannot read possible match: {0}".format(e))
+        self.statCache.markUnreadable(path)
+
+    if self.hashCache is not None:
+      matchingIdentities = set(self.hashCache.findIdentitiesByRoot(payloadFile.piecesRoot))
+      for path, identity in possibleMatches:
+        if identity in matchingIdentities:
+          log.debug("Pieces root of {0} found in the hash cache".format(path))
+          self.setMatchedByPiecesRoot(payloadFile, path)
+          return
+
+    for path, identity in possibleMatches:
+      if self.isCancelled:
+        return
+      if identity[2] != payloadFile.size:
+        # Only the root of a whole file is stored under its identity, and
+        #  a file of another size is no copy anyway.
+        continue
+      if self.hashCache is not None and self.hashCache.lookupRoot(identity) is not None:
+        # Computed before, and not the wanted root.
+        continue
+      if not self.statCache.isReadable(path):
+        self.unreadablePaths.add(path)
+        continue
+
+      stream = self.openStream(identity[0])
+      try:
+        piecesRoot = getPiecesRoot(path, payloadFile.size, self.dropReadRanges, stream)
+      except (IOError, OSError) as e:
+        log.warning("Cannot read possible match: {0}".format(e))
+        self.statCache.markUnreadable(path)
+        self.unreadablePaths.add(path)
+        continue
+      finally:
+        if stream is not None:
+          stream.close()
+
+      if piecesRoot is None:
+        continue
+      if self.hashCache is not None:
+        self.hashCache.storeRoot(identity, piecesRoot)
+      if piecesRoot == payloadFile.piecesRoot:
+        self.setMatchedByPiecesRoot(payloadFile, path)
+        return
+
+    # The possible matches are kept, since in a hybrid metafile some of the
+    #  v1 pieces of the file may still be found in them.
+    log.debug("No possible match has the pieces root of {0}".format(payloadFile))
+    payloadFile.status = "CHECKED_WITH_NO_MATCH"
+
+
+  def setMatchedByPiecesRoot(self, payloadFile, path):
+    log.info("Pieces root matched => {0}".format(path))
+    payloadFile.status = "MATCH_FOUND"
+    payloadFile.matchedFilePath = path
+    payloadFile.possibleMatches = [path]
+    if not self.metafile.pieces:
+      newPercentageAdded = (float(payloadFile.size)/self.metafile.payloadSize)*100
+      self.percentageMatched += newPercentageAdded
+
+
+  def streamPossibleMatches(self):
+    # The pieces lying inside of one file follow one another, so they are
+    #  gathered a file at a time, as the byte ranges read from each of the
+    #  file's possible matches, along with the hash each range must have.
+    ranges = []
+    for piece in self.metafile.pieces:
+      if self.isCancelled:
+        return
+      if piece.contributingFiles.getNumberOfFiles() != 1 or not piece.isVerifiable():
+        continue
+      contributingFile = piece.contributingFiles.listOfContributingFiles[0]
+      if ranges and ranges[0][0] is not contributingFile.referenceFile:
+        self.streamPossibleMatchesOfFile(ranges)
+        ranges = []
+      ranges.append((
+        contributingFile.referenceFile,
+        contributingFile.seekOffset,
+        contributingFile.readOffset,
+        contributingFile.padding,
+        piece.hash
+      ))
+
+    if ranges:
+      self.streamPossibleMatchesOfFile(ranges)
+
+
+  def streamPossibleMatchesOfFile(self, ranges):
+    payloadFile = ranges[0][0]
+    log.debug("Streaming {0} possible matches of {1}".format(len(payloadFile.possibleMatches), payloadFile))
+    for path in list(payloadFile.possibleMatches):
+      if self.isCancelled:
+        return
+      if not self.statCache.isReadable(path):
+        # Eliminated once its pieces are matched.
+        continue
+
+      buffer = self.metafile.pieces.buffers.take()
+      try:
+        self.streamPossibleMatch(path, ranges, buffer)
+      except (IOError, OSError) as e:
+        log.warning("Cannot read possible match: {0}".format(e))
+        self.statCache.markUnreadable(path)
+      finally:
+        self.metafile.pieces.buffers.giveBack(buffer)
+
+
+  def streamPossibleMatch(self, path, ranges, buffer):
+    # Ranges whose digest is already in the hash cache are skipped over.
+    #  Streaming stops at the first range not having the hash of its piece,
+    #  since the possible match is eliminated by that piece anyway. With an
+    #  I/O scheduler, the stream is read a buffer at a time in one slot of
+    #  its device, so that its reads are not interleaved with others on a
+    #  spinning disk, nor hold them up for the whole file.
+    identity = getFileIdentity(path)
+    stream = self.openStream(identity[0], STREAM_BUFFER_SIZE)
+    try:
+      with io.open(path, 'rb', buffering=STREAM_BUFFER_SIZE) as possibleMatchedFile:
+        fileno = possibleMatchedFile.fileno()
+        adviseKernel(fileno, 0, 0, POSIX_FADV_SEQUENTIAL)
+        try:
+          self.streamRanges(possibleMatchedFile, identity, ranges, buffer, stream)
+        finally:
+          if self.dropReadRanges:
+            adviseKernel(fileno, ranges[0][1], 0, POSIX_FADV_DONTNEED)
+    finally:
+      if stream is not None:
+        stream.close()
+
+
+  def openStream(self, device, turnSize=TURN_SIZE):
+    # A scheduled stream of a file on the device, or None without an I/O
+    #  scheduler.
+    if self.ioScheduler is None:
+      return None
+    return ScheduledStream(self.ioScheduler, device, self.hasBeenCancelled, turnSize)
+
+
+  def streamRanges(self, possibleMatchedFile, identity, ranges, buffer, stream=None):
+    position = 0
+    droppedUpTo = ranges[0][1]
+    for payloadFile, offset, length, padding, pieceHash in ranges:
+      if self.isCancelled:
+        return
+      digest = self.hashCache.lookup(identity, offset, length + padding)
+      if digest is None:
+        if position != offset:
+          possibleMatchedFile.seek(offset)
+        if stream is not None:
+          stream.beforeRead(length)
+          startTime = time.time()
+        data = readRange(possibleMatchedFile, buffer, length, padding)
+        if stream is not None:
+          stream.afterRead(min(len(data), length), time.time() - startTime)
+        digest = sha1(data).digest()
+        position = offset + length
+        self.hashCache.store(identity, offset, length + padding, digest)
+
+        # What has been hashed is dropped from the page cache a buffer at a
+        #  time as the stream passes.
+        if self.dropReadRanges and position - droppedUpTo >= STREAM_BUFFER_SIZE:
+          adviseKernel(possibleMatchedFile.fileno(), droppedUpTo, position - droppedUpTo, POSIX_FADV_DONTNEED)
+          droppedUpTo = position
+      if digest != pieceHash:
+        return
+
+
+  def cancel(self):
+    """Stops matching as soon as the piece being matched is done. May be
+    called from another thread than the one doing the matching."""
+    log.info("Matching cancelled")
+    self.isCancelled = True
+
+
+  def hasBeenCancelled(self):
+    return self.isCancelled
+
+
+  def separatePiecesSpanningFiles(self, piecesSpanningFiles):
+    for piece in self.metafile.pieces:
+      if self.isCancelled:
+        return
+      elif piece.contributingFiles.getNumberOfFiles() == 1:
+        yield piece
+      else:
+        piecesSpanningFiles.append(piece)
+
+
+  def verifyPiecesReadingAhead(self, pieces, hashingPool, readAhead):
+    # The possible matches of the next few pieces are handed to the hashing
+    #  pool before the current piece is matched. The pieces are still
+    #  matched one after another, in order, so that the outcome is the same
+    #  as when hashing without the pool.
+    upcomingPieces = deque()
+    for piece in pieces:
+      self.eliminateUnreadablePossibleMatches(piece)
+      piece.submitToHashingPool(self.doFastVerification, hashingPool)
+      upcomingPieces.append(piece)
+      if len(upcomingPieces) > readAhead:
+        self.verifyPiece(upcomingPieces.popleft(), hashingPool)
+
+    while upcomingPieces:
+      self.verifyPiece(upcomingPieces.popleft(), hashingPool)
+
+
+  def verifyPiece(self, piece, hashingPool=None):
+    while True:
+      self.eliminateUnreadablePossibleMatches(piece)
+      try:
+        piece.findMatch(
+          fastVerification=self.doFastVerification,
+          hashCache=self.hashCache,
+          hashingPool=hashingPool
+        )
+        break
+      except (IOError, OSError) as e:
+        # The possible match could be read when it was checked, but has
+        #  been deleted or made unreadable since. The piece is matched again
+        #  without it.
+        if e.filename not in self.getPossibleMatchesOfPiece(piece):
+          raise
+        log.warning("Cannot read possible match: {0}".format(e))
+        self.statCache.markUnreadable(e.filename)
+        for contributingFile in piece.contributingFiles.listOfContributingFiles:
+          if e.filename in contributingFile.referenceFile.possibleMatches:
+            self.eliminateUnreadablePaths(contributingFile.referenceFile, [e.filename])
+
+    if piece.isVerified:
+      newPercentageAdded = (float(piece.size)/self.metafile.payloadSize)*100
+      log.debug("Updating percentage stats => +" + str(newPercentageAdded) + "%")
+      self.percentageMatched += newPercentageAdded
+    log.debug("~"*80)
+
+
+  def eliminateUnreadablePossibleMatches(self, piece):
+    # Whether the possible matches of a file can be read is checked once,
+    #  the first time one of the file's pieces is about to be matched. A
+    #  possible match that cannot be read after that is eliminated once
+    #  reading it fails.
+    for contributingFile in piece.contributingFiles.listOfContributingFiles:
+      payloadFile = contributingFile.referenceFile
+      if payloadFile in self.checkedFiles:
+        continue
+      self.checkedFiles.add(payloadFile)
+      unreadablePaths = [p for p in payloadFile.possibleMatches if not self.statCache.isReadable(p)]
+      if unreadablePaths:
+        self.eliminateUnreadablePaths(payloadFile, unreadablePaths)
+
+
+  def eliminateUnreadablePaths(self, payloadFile, unreadablePaths):
+    for path in unreadablePaths:
+      if path not in self.unreadablePaths:
+        log.warning("Cannot read possible match, ignoring: '{0}'"
+                    " (perhaps execute # chmod +r '{0}')".format(path))
+    self.unreadablePaths.update(unreadablePaths)
+    payloadFile.eliminatePossibleMatches(unreadablePaths)
+
+
+  def getPossibleMatchesOfPiece(self, piece):
+    possibleMatches = set()
+    for contributingFile in piece.contributingFiles.listOfContributingFiles:
+      possibleMatches.update(contributingFile.referenceFile.possibleMatches)
+    return possibleMatches
+
+
+  def getVerifiedPieces(self):
+    """Returns one flag for each piece of the metafile, which is set if the
+    piece was verified and all of the files contributing to it have been
+    positively matched."""
+    return [
+      bool(piece.isVerified) and piece.contributingFiles.haveBeenPositivelyMatched()
+      for piece in self.metafile.pieces
+    ]
+
+
+  def getHashedPieces(self):
+    """Returns one flag for each piece of the metafile, which is set if the
+    piece was hashed from the paths its files are matched to, rather than
+    trusted by fast verification, or hashed from other paths."""
+    return [
+      bool(piece.isHashed) and piece.contributingFiles.haveKeptMatchedPaths()
+      for piece in self.metafile.pieces
+    ]
+
+
+  def recheckSampleOfVerifiedPieces(self, sampleSize):
+    """With fast verification, most pieces are trusted without having been
+    hashed. Rather than rechecking every piece, hash a random sample of the
+    verified pieces from the matched files. Returns False as soon as one of
+    them does not match."""
+    verifiedPieces = [i for i, isVerified in enumerate(self.getVerifiedPieces()) if isVerified]
+    sample = random.sample(verifiedPieces, min(sampleSize, len(verifiedPieces)))
+    log.info("Rechecking {0} of {1} verified pieces".format(len(sample), len(verifiedPieces)))
+    try:
+      for pieceIndex in sorted(sample):
+        piece = self.metafile.pieces[pieceIndex]
+        if not piece.isProducedByMatchedFiles():
+          log.warning("Recheck failed for {0}".format(piece))
+          return False
+      return True
+    except ReadCancelled:
+      log.info("Recheck cancelled while waiting to read")
+      return False
+    finally:
+      self.reader.close()
+
+
   def createPayloadDirectoryStructure(self, directory):
     """For the directory structure outlined in the metafile, there may be
     other directories that need to be created in order to properly relink
@@ -0,0 +1,95 @@
+import time
+import logging
+from hashlib import sha256
+from buffers import readRange
+from readers import adviseKernel, POSIX_FADV_SEQUENTIAL, POSIX_FADV_DONTNEED
+
+log = logging.getLogger(__name__)
+
+# A v2 metafile (BEP 52) hashes every file on its own, as the leaves of a
+#  binary merkle tree whose leaves are the SHA256 of each 16KiB block of the
+#  file. The leaves past the end of the file, up to the next power of two,
+#  are zero.
+BLOCK_SIZE = 16*1024
+HASH_SIZE = 32
+READ_SIZE = 64*BLOCK_SIZE
+
+
+class MerkleTree:
+  """Folds the leaves of a merkle tree, added in order, into the hashes of
+  the largest complete subtrees so far, of which there is at most one of
+  each height. A file of n blocks is hashed keeping log2(n) hashes rather
+  than all of its leaves."""
+  def __init__(self):
+    self.subtrees = []
+    # The hash of a subtree of zero leaves, of each height.
+    self.padding = [b'\0'*HASH_SIZE]
+
+
+  def addLeaf(self, leaf):
+    height = 0
+    while self.subtrees and self.subtrees[-1][0] == height:
+      leaf = sha256(self.subtrees.pop()[1] + leaf).digest()
+      height += 1
+    self.subtrees.append((height, leaf))
+
+
+  def getPadding(self, height):
+    while len(self.padding) <= height:
+      self.padding.append(sha256(self.padding[-1] + self.padding[-1]).digest())
+    return self.padding[height]
+
+
+  def getRoot(self):
+    # The last subtree is padded with zero leaves up to the height of the
+    #  one before it, and joined to it, until one is left.
+    if not self.subtrees:
+      return None
+
+    height, root = self.subtrees[-1]
+    for leftHeight, left in reversed(self.subtrees[:-1]):
+      while height < leftHeight:
+        root = sha256(root + self.getPadding(height)).digest()
+        height += 1
+      root = sha256(left + root).digest()
+      height += 1
+    return root
+
+
+def getPiecesRoot(path, size, dropReadRanges=False, stream=None):
+  # Returns the pieces root of the file, or None if the file is not of the
+  #  given size. Raises IOError or OSError if the file cannot be read. The
+  #  file is read once, from start to end, and with dropReadRanges, what
+  #  has been read is dropped from the page cache. With a scheduled stream,
+  #  the file is read in turns with the other reads of its device.
+  log.debug("Computing the pieces root of {0}".format(path))
+  tree = MerkleTree()
+  bytesRead = 0
+  buffer = bytearray(READ_SIZE)
+  with open(path, 'rb') as f:
+    adviseKernel(f.fileno(), 0, 0, POSIX_FADV_SEQUENTIAL)
+    try:
+      while bytesRead < size:
+        length = min(READ_SIZE, size - bytesRead)
+        if stream is not None:
+          stream.beforeRead(length)
+          startTime = time.time()
+        data = readRange(f, buffer, length)
+        if stream is not None:
+          stream.afterRead(len(data), time.time() - startTime)
+        if not data:
+          return None
+        for start in range(0, len(data), BLOCK_SIZE):
+          tree.addLeaf(sha256(data[start:start+BLOCK_SIZE]).digest())
+        if dropReadRanges:
+          adviseKernel(f.fileno(), bytesRead, len(data), POSIX_FADV_DONTNEED)
+        bytesRead += len(data)
+        if len(data) % BLOCK_SIZE and bytesRead < size:
+          # Only the last block of the file may be short.
+          return None
+    finally:
+      # Pages still being read ahead when their range was dropped are
+      #  dropped once done with the file.
+      if dropReadRanges:
+        adviseKernel(f.fileno(), 0, 0, POSIX_FADV_DONTNEED)
+  return tree.getRoot()
@@ -38,18 +38,14 @@ def getMetafileFromDict( metafileDict ):
   module_logger.debug("Converting metafile dictionary to BitTorrentMetafile object")
   files = PayloadFile.getPayloadFilesFromMetafileDict( metafileDict )
   pieces = PayloadPiece.getPiecesFromMetafileDict( metafileDict, files )
-  pieceSize = PayloadPiece.getPieceSizeFromDict(metafileDict)
-  finalPieceSize = PayloadPiece.getFinalPieceSizeFromDict(metafileDict)
-  numberOfPieces = PayloadPiece.getNumberOfPiecesFromDict(metafileDict)
-  payloadSize = PayloadPiece.getPayloadSizeFromMetafileDict( metafileDict )
 
   metafile = BitTorrentMetafile(
     files=files,
     pieces=pieces,
-    pieceSize=pieceSize, 
-    finalPieceSize=finalPieceSize, 
-    numberOfPieces=numberOfPieces, 
-    payloadSize=payloadSize
+    pieceSize=pieces.pieceSize,
+    finalPieceSize=pieces.finalPieceSize,
+    numberOfPieces=pieces.numberOfPieces,
+    payloadSize=pieces.payloadSize
   )
   
   module_logger.debug("Metafile decoding complete!") 
@@ -0,0 +1,236 @@
+import io
+import os
+import sys
+import mmap
+import time
+import ctypes
+import ctypes.util
+import logging
+import threading
+from collections import OrderedDict
+from buffers import readRange, fillWithZeros
+from hashcache import getFileIdentity
+
+log = logging.getLogger(__name__)
+
+# Reads bypassing the page cache start and end on a multiple of this many
+#  bytes, into memory aligned to it as well.
+DIRECT_IO_ALIGNMENT = 4096
+
+# Seconds for which a mapped file is taken to be unchanged since it was
+#  last checked, rather than checking it on every read.
+MAPPING_CHECK_INTERVAL = 1.0
+
+# The values of the advice on Linux, for Pythons without os.posix_fadvise.
+POSIX_FADV_SEQUENTIAL = getattr(os, 'POSIX_FADV_SEQUENTIAL', 2)
+POSIX_FADV_DONTNEED = getattr(os, 'POSIX_FADV_DONTNEED', 4)
+
+
+def loadFadvise():
+  # posix_fadvise is part of os from Python 3.3. Before that, it is called
+  #  in the C library, on Linux. Elsewhere, no advice is given.
+  if hasattr(os, 'posix_fadvise'):
+    return os.posix_fadvise
+  if not sys.platform.startswith('linux'):
+    return None
+  try:
+    libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6')
+    fadvise = libc.posix_fadvise64
+  except (OSError, AttributeError):
+    return None
+  fadvise.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int]
+  fadvise.restype = ctypes.c_int
+  return fadvise
+
+fadvise = loadFadvise()
+
+
+def adviseKernel(fileno, offset, length, advice):
+  # Advice is only a hint, so failing to give it is ignored. A length of 0
+  #  reaches the end of the file.
+  if fadvise is None:
+    return
+  try:
+    fadvise(fileno, offset, length, advice)
+  except OSError:
+    pass
+
+
+def getReader(name, dropReadRanges=False):
+  if name == "mmap":
+    return MmapReader()
+  elif name == "direct":
+    if hasattr(os, 'O_DIRECT'):
+      return DirectReader()
+    log.warning("Reads bypassing the page cache are not supported here, reading through it")
+  return BufferedReader(dropReadRanges)
+
+
+def getSlice(data, offset, length):
+  # A view of part of a mapping, copying nothing. Python 2 makes no
+  #  memoryview of a mapping, but hashlib takes a buffer just as well.
+  return buffer(data, offset, length)
+
+
+class BufferedReader:
+  """Reads a range of a possible match by opening the file, seeking, and
+  reading the range into the buffer given. Suits any storage.
+
+  Possible matches are mostly read once, yet every byte read stays in the
+  page cache, pushing out the pieces being seeded. With dropReadRanges, a
+  range the caller will not read again is dropped from the page cache once
+  it has been read."""
+  def __init__(self, dropReadRanges=False):
+    self.dropReadRanges = dropReadRanges
+
+
+  def read(self, path, offset, length, padding, buffer, readOnce=False):
+    with open(path, 'rb') as possibleMatchedFile:
+      possibleMatchedFile.seek(offset)
+      data = readRange(possibleMatchedFile, buffer, length, padding)
+      if readOnce and self.dropReadRanges:
+        adviseKernel(possibleMatchedFile.fileno(), offset, length, POSIX_FADV_DONTNEED)
+      return data
+
+
+  def close(self):
+    pass
+
+
+class MmapReader:
+  """Maps each possible match into memory once, and hands out slices of the
+  mapping, so that reading a range neither copies it nor makes a system
+  call. Suits libraries already in the page cache, or on fast solid state
+  drives.
+
+  At most maxMappings files are mapped at once. A mapping making way for
+  another is dropped rather than closed, so that it lasts for as long as a
+  slice of it is being hashed.
+
+  Reading a file that was truncated while it is mapped crashes the process.
+  A file whose size or modification time changed since it was mapped is
+  read through the page cache instead. It is checked at most every
+  MAPPING_CHECK_INTERVAL seconds, though, and a file truncated in between,
+  or while a slice is being hashed, still crashes it, so this reader is
+  not meant for libraries being written to."""
+  def __init__(self, maxMappings=64):
+    self.maxMappings = maxMappings
+    self.mappings = OrderedDict()
+    self.lock = threading.Lock()
+    self.bufferedReader = BufferedReader()
+
+
+  def read(self, path, offset, length, padding, buffer, readOnce=False):
+    # The pages of the mapping are what is read from, so they are kept.
+    mapping = self.getMapping(path)
+    if mapping is None:
+      return self.bufferedReader.read(path, offset, length, padding, buffer, readOnce)
+    end = min(offset + length, len(mapping))
+    if end == offset + length and not padding:
+      return getSlice(mapping, offset, length)
+
+    # A range followed by the zeros of pad files, or cut short by the end
+    #  of the file, is put together in the buffer instead.
+    view = memoryview(buffer)
+    bytesRead = max(0, end - offset)
+    view[:bytesRead] = mapping[offset:offset+bytesRead]
+    if bytesRead < length:
+      return view[:bytesRead]
+    fillWithZeros(view, length, length + padding)
+    return view[:length + padding]
+
+
+  def getMapping(self, path):
+    # Returns None if the file changed since it was mapped, dropping the
+    #  mapping. It is mapped again on the next read.
+    now = time.time()
+    with self.lock:
+      mapped = self.mappings.pop(path, None)
+      if mapped is not None and now - mapped[2] < MAPPING_CHECK_INTERVAL:
+        self.mappings[path] = mapped
+        return mapped[0]
+
+    if mapped is not None:
+      mapping, identity, checkTime = mapped
+      if getFileIdentity(path) != identity:
+        log.debug("{0} changed since it was mapped, reading it through the page cache".format(path))
+        return None
+    else:
+      with open(path, 'rb') as possibleMatchedFile:
+        identity = getFileIdentity(path)
+        if identity[2] == 0:
+          # An empty file cannot be mapped.
+          mapping = ''
+        else:
+          mapping = mmap.mmap(possibleMatchedFile.fileno(), 0, access=mmap.ACCESS_READ)
+
+    with self.lock:
+      self.mappings[path] = (mapping, identity, now)
+      while len(self.mappings) > self.maxMappings:
+        self.mappings.popitem(last=False)
+    return mapping
+
+
+  def close(self):
+    with self.lock:
+      self.mappings.clear()
+
+
+class DirectReader:
+  """Reads ranges of possible matches around the page cache (O_DIRECT), so
+  that matching a large library neither evicts the pages of the files being
+  seeded, nor spends time copying through the cache data read only once.
+  Suits large libraries on spinning disks, or wherever the page cache is
+  better kept for seeding.
+
+  Each thread reads into an aligned buffer of its own, which is reused.
+  Files on filesystems refusing such reads are read through the page
+  cache instead."""
+  def __init__(self):
+    self.alignedBuffers = threading.local()
+
+
+  def read(self, path, offset, length, padding, buffer, readOnce=False):
+    start = offset - offset % DIRECT_IO_ALIGNMENT
+    end = offset + length
+    end += -end % DIRECT_IO_ALIGNMENT
+    alignedBuffer = self.getAlignedBuffer(end - start)
+
+    try:
+      fd = os.open(path, os.O_RDONLY | os.O_DIRECT)
+    except OSError as e:
+      log.debug("Cannot bypass the page cache for {0}: {1}".format(path, e))
+      return BufferedReader(dropReadRanges=True).read(path, offset, length, padding, buffer, readOnce)
+
+    with io.FileIO(fd, 'r') as possibleMatchedFile:
+      possibleMatchedFile.seek(start)
+      bytesRead = 0
+      while bytesRead < end - start:
+        n = possibleMatchedFile.readinto(
+          (ctypes.c_char * (end - start - bytesRead)).from_buffer(alignedBuffer, bytesRead)
+        )
+        if not n:
+          break
+        bytesRead += n
+
+    bytesRead = min(bytesRead - (offset - start), length)
+    if bytesRead < length or not padding:
+      return getSlice(alignedBuffer, offset - start, max(0, bytesRead))
+
+    view = memoryview(buffer)
+    view[:length] = alignedBuffer[offset - start:offset - start + length]
+    fillWithZeros(view, length, length + padding)
+    return view[:length + padding]
+
+
+  def getAlignedBuffer(self, size):
+    # Anonymous mappings are aligned to pages.
+    alignedBuffer = getattr(self.alignedBuffers, 'buffer', None)
+    if alignedBuffer is None or len(alignedBuffer) < size:
+      alignedBuffer = mmap.mmap(-1, size)
+      self.alignedBuffers.buffer = alignedBuffer
+    return alignedBuffer
+
+
+  def close(self):
+    pass
@@ -0,0 +1,219 @@
+import os
+import stat
+import threading
+import Queue
+import logging
+
+# scandir is part of os from Python 3.5, and a backport for older versions.
+#  Without either, directories are walked with listdir and stat.
+try:
+  from os import scandir
+except ImportError:
+  try:
+    from scandir import scandir
+  except ImportError:
+    scandir = None
+
+log = logging.getLogger(__name__)
+
+# The number of entries handed from a scanning thread to the thread writing
+#  them at once, and the number of such batches waiting to be written before
+#  the scanning threads wait for the writer.
+SCAN_BATCH_SIZE = 1000
+SCAN_QUEUE_SIZE = 64
+
+# The number of directories of a device queued to be listed by whichever
+#  thread is free. A thread finding more subdirectories than fit lists the
+#  rest itself, depth first, as os.walk does, so that a wide tree is not
+#  held in memory a whole level at a time.
+UNLISTED_QUEUE_SIZE = 1024
+
+
+def walkDirectoryTrees(contentDirectories, threadsPerDevice=1):
+  # Yields ("file", (directory, filename, size, device, inode)) for every
+  #  file below the content directories, and ("directory", (path, mtime,
+  #  inode)) for every directory once all of its entries have been listed.
+  #
+  # The content directories are grouped by the device they are stored on,
+  #  and every device is walked by its own threads, so that the time spent
+  #  waiting on one disk, or on a network mount, overlaps with the others.
+  #  The entries are yielded on the calling thread, which is the only one
+  #  writing them to the cache. Nothing but the batches waiting to be
+  #  written, and the directories still to be listed, is held in memory.
+  directoriesOnDevice = {}
+  for contentDirectory in contentDirectories:
+    contentDirectory = os.path.abspath(contentDirectory)
+    try:
+      device = os.stat(contentDirectory).st_dev
+    except OSError as e:
+      errorEncounteredWhileWalking(e)
+      continue
+    log.info("Collecting all files in content directory => {0}".format(contentDirectory))
+    directoriesOnDevice.setdefault(device, []).append(contentDirectory)
+
+  scannedEntries = Queue.Queue(maxsize=SCAN_QUEUE_SIZE)
+  stopped = threading.Event()
+  for device, directories in directoriesOnDevice.items():
+    DeviceScanner(device, directories, threadsPerDevice, scannedEntries, stopped).start()
+
+  devicesBeingScanned = len(directoriesOnDevice)
+  try:
+    while devicesBeingScanned:
+      batch = scannedEntries.get()
+      if batch is None:
+        devicesBeingScanned -= 1
+      else:
+        for entry in batch:
+          yield entry
+  finally:
+    # The scanning threads stop early when the walk is abandoned.
+    stopped.set()
+
+
+class DeviceScanner:
+  """Lists the directories stored on one device on a few threads. Each
+  subdirectory found is queued to be listed by whichever thread is free, and
+  the entries found are handed on in batches. Once every directory has been
+  listed, None is handed on. A device is listed by at least one thread."""
+  def __init__(self, device, directories, numberOfThreads, scannedEntries, stopped):
+    self.device = device
+    self.numberOfThreads = max(1, numberOfThreads)
+    self.scannedEntries = scannedEntries
+    self.stopped = stopped
+
+    self.unlistedDirectories = Queue.Queue(maxsize=max(UNLISTED_QUEUE_SIZE, len(directories)))
+    for directory in directories:
+      self.unlistedDirectories.put(directory)
+
+
+  def start(self):
+    log.debug("Scanning device {0} on {1} threads".format(self.device, self.numberOfThreads))
+    for i in range(self.numberOfThreads):
+      thread = threading.Thread(
+        target=self.listQueuedDirectories,
+        name="localbff-scan-{0}-{1}".format(self.device, i)
+      )
+      thread.daemon = True
+      thread.start()
+
+    thread = threading.Thread(target=self.waitForDirectoriesToBeListed)
+    thread.daemon = True
+    thread.start()
+
+
+  def waitForDirectoriesToBeListed(self):
+    self.unlistedDirectories.join()
+    for i in range(self.numberOfThreads):
+      self.unlistedDirectories.put(None)
+    self.handOn(None)
+
+
+  def listQueuedDirectories(self):
+    while True:
+      directory = self.unlistedDirectories.get()
+      if directory is None:
+        return
+
+      # The subdirectories that did not fit into the queue are listed
+      #  along with the directory taken from it.
+      directories = [directory]
+      try:
+        while directories:
+          directory = directories.pop()
+          try:
+            if not self.stopped.is_set():
+              self.listDirectory(directory, directories)
+          except Exception:
+            log.exception("Failed to list {0}".format(directory))
+      finally:
+        self.unlistedDirectories.task_done()
+
+
+  def listDirectory(self, directory, directories):
+    batch = []
+    try:
+      # Stat the directory before listing it, so that an entry created
+      #  while listing leaves the directory looking changed next time.
+      directoryState = getDirectoryState(directory)
+      for filename, status in scanDirectory(directory):
+        if status is None:
+          try:
+            self.unlistedDirectories.put_nowait(os.path.join(directory, filename))
+          except Queue.Full:
+            directories.append(os.path.join(directory, filename))
+        else:
+          batch.append(("file", (directory, filename, status.st_size, status.st_dev, status.st_ino)))
+          if len(batch) >= SCAN_BATCH_SIZE:
+            self.handOn(batch)
+            batch = []
+
+    except OSError as e:
+      # The directory is left without a state, so that it is listed again
+      #  by the next refresh.
+      errorEncounteredWhileWalking(e)
+
+    else:
+      batch.append(("directory", directoryState))
+
+    self.handOn(batch)
+
+
+  def handOn(self, batch):
+    while not self.stopped.is_set():
+      try:
+        self.scannedEntries.put(batch, timeout=0.1)
+        return
+      except Queue.Full:
+        pass
+
+
+def scanDirectory(directory):
+  # Yields the name of every subdirectory and regular file in the directory,
+  #  along with the status of each file, or None for a subdirectory. As in
+  #  os.walk, symbolic links to files are followed, and symbolic links to
+  #  directories are not. Where scandir is available, the type of each
+  #  entry is known from listing the directory, so files are stat'ed once
+  #  and subdirectories not at all.
+  if scandir is not None:
+    for entry in scandir(directory):
+      if entry.is_dir(follow_symlinks=False):
+        yield entry.name, None
+      elif entry.is_file():
+        status = statEntry(entry.path, entry.stat)
+        if status is not None:
+          yield entry.name, status
+
+  else:
+    for filename in os.listdir(directory):
+      path = os.path.join(directory, filename)
+      status = statEntry(path, os.stat, path)
+      if status is None:
+        continue
+      if stat.S_ISDIR(status.st_mode):
+        if not os.path.islink(path):
+          yield filename, None
+      elif stat.S_ISREG(status.st_mode):
+        yield filename, status
+
+
+def statEntry(path, statFunction, *args):
+  try:
+    return statFunction(*args)
+  except OSError:
+    log.warning("Problem with accessing file => {0}".format(path))
+    return None
+
+
+def getDirectoryState(directory):
+  # The modification time of a directory changes whenever an entry is
+  #  created, deleted or renamed in it, but not when a file in it is
+  #  written to, nor when anything changes further down the tree.
+  status = os.stat(directory)
+  return (directory, status.st_mtime, status.st_ino)
+
+
+def errorEncounteredWhileWalking( error ):
+  log.warning("Error accessing path: '{0}'".format(error.filename))
+  log.warning(error)
+  log.warning("To fix this problem, perhaps execute the following command:")
+  log.warning("# chmod -R +rx '{0}'".format(error.filename))
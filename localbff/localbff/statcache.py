@@ -0,0 +1,45 @@
+import os
+import time
+import threading
+import logging
+from collections import OrderedDict
+
+log = logging.getLogger(__name__)
+
+
+class StatCache:
+  """Remembers for a short while whether a possible match can be read, so
+  that a file tried for many pieces, or by several metafiles matched at
+  once, is only checked once. At most maxEntries results are kept, and the
+  least recently used result is forgotten first."""
+  def __init__(self, timeToLive=60, maxEntries=10000):
+    self.timeToLive = timeToLive
+    self.maxEntries = maxEntries
+    self.results = OrderedDict()
+    self.lock = threading.Lock()
+
+
+  def isReadable(self, path):
+    now = time.time()
+    with self.lock:
+      result = self.results.pop(path, None)
+      if result is not None and now - result[0] < self.timeToLive:
+        self.results[path] = result
+        return result[1]
+
+    isReadable = os.access(path, os.R_OK)
+    self.remember(path, now, isReadable)
+    return isReadable
+
+
+  def markUnreadable(self, path):
+    # For a path that could not be opened or read after it was checked.
+    self.remember(path, time.time(), False)
+
+
+  def remember(self, path, now, isReadable):
+    with self.lock:
+      self.results.pop(path, None)
+      self.results[path] = (now, isReadable)
+      while len(self.results) > self.maxEntries:
+        self.results.popitem(last=False)
@@ -9,6 +9,12 @@ def isSingleFileMetafile( metafileDict ):
   return 'length' in metafileDict['info'].keys()
 
 
+def isPadFile( fileDict ):
+  # Pad files (BEP 47) hold zeros, so that the file after them starts on a
+  #  piece boundary. They are never written to disk.
+  return 'p' in fileDict.get('attr', '')
+
+
 def prunedMetainfoDict(metainfoDict):
   pruned = copy.deepcopy(metainfoDict)
   pruned['announce'] = 'PRUNED FOR PRIVACY REASONS'
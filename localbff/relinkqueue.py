@@ -0,0 +1,187 @@
+#
+# relinkqueue.py
+#
+# Copyright (C) 2013 Doug McGeehan <doug.mcgeehan@mst.edu>
+# Copyright (C) 2013 Maximilian Schroeder
+# Copyright (C) 2013 Hiren Patel
+#
+# Basic plugin template created by:
+# Copyright (C) 2008 Martijn Voncken <mvoncken@gmail.com>
+# Copyright (C) 2007-2009 Andrew Resch <andrewresch@gmail.com>
+# Copyright (C) 2009 Damien Churchill <damoxc@gmail.com>
+#
+# Deluge is free software.
+#
+# You may redistribute it and/or modify it under the terms of the
+# GNU General Public License, as published by the Free Software
+# Foundation; either version 3 of the License, or (at your option)
+# any later version.
+#
+# deluge is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with deluge.    If not, write to:
+# 	The Free Software Foundation, Inc.,
+# 	51 Franklin Street, Fifth Floor
+# 	Boston, MA  02110-1301, USA.
+#
+#    In addition, as a special exception, the copyright holders give
+#    permission to link the code of portions of this program with the OpenSSL
+#    library.
+#    You must obey the GNU General Public License in all respects for all of
+#    the code used other than OpenSSL. If you modify file(s) with this
+#    exception, you may extend this exception to your version of the file(s),
+#    but you are not obligated to do so. If you do not wish to do so, delete
+#    this exception statement from your version. If you delete this exception
+#    statement from all source files in the program, then also delete it here.
+#
+import itertools
+import logging
+from twisted.internet import defer
+
+log = logging.getLogger(__name__)
+
+
+class RelinkJob(object):
+    def __init__(self, torrent_id, priority, order):
+        self.torrent_id = torrent_id
+        self.priority = priority
+        self.order = order
+        self.state = "Queued"
+        self.cancelled = False
+
+        # Called when a running job is cancelled, so that the work done
+        #  for it off the reactor can stop early.
+        self.on_cancel = None
+
+        # The potential matches of each payload file, when they were already
+        #  looked up before the job was queued.
+        self.potential_matches = None
+
+        # Fired once the job has finished, for those waiting on it.
+        self.waiting = []
+
+    def get_status(self):
+        return {
+            "torrent_id": self.torrent_id,
+            "priority": self.priority,
+            "state": self.state,
+        }
+
+
+class RelinkQueue(object):
+    """Runs relink jobs, at most max_running_jobs at a time. Queued jobs with
+    a higher priority are started first, and jobs of equal priority in the
+    order they were queued.
+
+    run_job is called on the reactor with the job to start, and returns a
+    Deferred that fires once the job is done."""
+    def __init__(self, run_job, max_running_jobs=1):
+        self.run_job = run_job
+        self.max_running_jobs = max_running_jobs
+        self.queued_jobs = []
+        self.running_jobs = {}
+        self.job_order = itertools.count()
+
+
+    def add(self, torrent_id, priority=0, potential_matches=None):
+        if torrent_id in self.running_jobs or self.get_queued_job(torrent_id):
+            log.debug("Torrent {0} is already queued for relinking".format(torrent_id))
+            return
+
+        log.debug("Queueing torrent {0} for relinking".format(torrent_id))
+        job = RelinkJob(torrent_id, priority, next(self.job_order))
+        job.potential_matches = potential_matches
+        self.queued_jobs.append(job)
+        self.start_jobs()
+
+
+    def start_jobs(self):
+        while self.queued_jobs and len(self.running_jobs) < self.max_running_jobs:
+            job = min(self.queued_jobs, key=lambda j: (-j.priority, j.order))
+            self.queued_jobs.remove(job)
+            self.running_jobs[job.torrent_id] = job
+
+            log.debug("Starting relink of torrent {0}".format(job.torrent_id))
+            job.state = "Running"
+            d = defer.maybeDeferred(self.run_job, job)
+            d.addErrback(self.job_failed, job)
+            d.addBoth(self.job_finished, job)
+
+
+    def job_failed(self, failure, job):
+        log.error("Relinking torrent {0} failed:\n{1}".format(
+            job.torrent_id, failure.getTraceback()
+        ))
+
+
+    def job_finished(self, result, job):
+        del self.running_jobs[job.torrent_id]
+        for d in job.waiting:
+            d.callback(None)
+        self.start_jobs()
+
+
+    def get_queued_job(self, torrent_id):
+        for job in self.queued_jobs:
+            if job.torrent_id == torrent_id:
+                return job
+        return None
+
+
+    def get_jobs(self):
+        """Returns the status of the running jobs, followed by the queued
+        jobs in the order they will be started."""
+        running_jobs = sorted(self.running_jobs.values(), key=lambda j: j.order)
+        queued_jobs = sorted(self.queued_jobs, key=lambda j: (-j.priority, j.order))
+        return [job.get_status() for job in running_jobs + queued_jobs]
+
+
+    def set_priority(self, torrent_id, priority):
+        job = self.get_queued_job(torrent_id)
+        if job is None:
+            return False
+
+        log.debug("Priority of torrent {0} set to {1}".format(torrent_id, priority))
+        job.priority = priority
+        return True
+
+
+    def set_max_running_jobs(self, max_running_jobs):
+        self.max_running_jobs = max_running_jobs
+        self.start_jobs()
+
+
+    def cancel(self, torrent_id):
+        job = self.get_queued_job(torrent_id)
+        if job is not None:
+            log.debug("Removing torrent {0} from the relink queue".format(torrent_id))
+            self.queued_jobs.remove(job)
+            return True
+
+        job = self.running_jobs.get(torrent_id)
+        if job is not None:
+            log.debug("Cancelling running relink of torrent {0}".format(torrent_id))
+            job.cancelled = True
+            job.state = "Cancelled"
+            if job.on_cancel is not None:
+                job.on_cancel()
+            return True
+
+        return False
+
+
+    def cancel_all(self):
+        """Cancels every job. Returns a Deferred that fires once the jobs
+        that were running have finished."""
+        self.queued_jobs = []
+        finished = []
+        for torrent_id in list(self.running_jobs):
+            d = defer.Deferred()
+            self.running_jobs[torrent_id].waiting.append(d)
+            finished.append(d)
+            self.cancel(torrent_id)
+        return defer.DeferredList(finished)
@@ -0,0 +1,225 @@
+#
+# watcher.py
+#
+# Copyright (C) 2013 Doug McGeehan <doug.mcgeehan@mst.edu>
+# Copyright (C) 2013 Maximilian Schroeder
+# Copyright (C) 2013 Hiren Patel
+#
+# Basic plugin template created by:
+# Copyright (C) 2008 Martijn Voncken <mvoncken@gmail.com>
+# Copyright (C) 2007-2009 Andrew Resch <andrewresch@gmail.com>
+# Copyright (C) 2009 Damien Churchill <damoxc@gmail.com>
+#
+# Deluge is free software.
+#
+# You may redistribute it and/or modify it under the terms of the
+# GNU General Public License, as published by the Free Software
+# Foundation; either version 3 of the License, or (at your option)
+# any later version.
+#
+# deluge is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.
+# See the GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with deluge.    If not, write to:
+# 	The Free Software Foundation, Inc.,
+# 	51 Franklin Street, Fifth Floor
+# 	Boston, MA  02110-1301, USA.
+#
+#    In addition, as a special exception, the copyright holders give
+#    permission to link the code of portions of this program with the OpenSSL
+#    library.
+#    You must obey the GNU General Public License in all respects for all of
+#    the code used other than OpenSSL. If you modify file(s) with this
+#    exception, you may extend this exception to your version of the file(s),
+#    but you are not obligated to do so. If you do not wish to do so, delete
+#    this exception statement from your version. If you delete this exception
+#    statement from all source files in the program, then also delete it here.
+#
+import os
+import logging
+from twisted.internet import reactor
+from twisted.internet import threads
+
+# Watching the content directories relies on inotify, which is only
+#  available on Linux.
+try:
+    from twisted.internet import inotify
+    from twisted.python import filepath
+except ImportError:
+    inotify = None
+
+log = logging.getLogger(__name__)
+
+
+class ContentDirectoryWatcher(object):
+    """Keeps the cache up to date with the files created, deleted, renamed
+    and written to in the content directories. Changes are collected for
+    batch_delay seconds and applied to the cache all at once."""
+    def __init__(self, cache, batch_delay=5):
+        self.cache = cache
+        self.batch_delay = batch_delay
+        self.notifier = None
+        self.watched_directories = set()
+
+        self.changed_paths = set()
+        self.deleted_paths = set()
+        self.deleted_directories = set()
+        self.pending_update = None
+        self.applying_changes = False
+
+
+    def start(self, dirs):
+        if inotify is None:
+            log.warning("inotify is not available, content directories"
+                        " will not be watched for changes.")
+            return False
+
+        self.notifier = inotify.INotify()
+        self.notifier.startReading()
+        for d in dirs:
+            self.watch(d)
+        return True
+
+
+    def stop(self):
+        if self.pending_update is not None and self.pending_update.active():
+            self.pending_update.cancel()
+            self.update_cache()
+
+        if self.notifier is not None:
+            self.notifier.stopReading()
+            self.notifier.loseConnection()
+            self.notifier = None
+        self.watched_directories.clear()
+
+
+    def watch(self, directory):
+        if self.notifier is None or directory in self.watched_directories:
+            return
+
+        log.info("Watching {0} for changes".format(directory))
+        # A change of permissions is watched for as well, so that a file
+        #  made readable again is given as a potential match again.
+        mask = (
+            inotify.IN_CREATE | inotify.IN_DELETE | inotify.IN_MODIFY |
+            inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_FROM | inotify.IN_MOVED_TO |
+            inotify.IN_ATTRIB
+        )
+        try:
+            # Every subdirectory takes up one inotify watch, and new
+            #  subdirectories are watched as they are created.
+            self.notifier.watch(
+                filepath.FilePath(directory),
+                mask=mask,
+                autoAdd=True,
+                recursive=True,
+                callbacks=[self.notify]
+            )
+            self.watched_directories.add(directory)
+        except Exception as e:
+            log.warning("Cannot watch {0}: {1}".format(directory, e))
+            log.warning("Perhaps raise fs.inotify.max_user_watches?")
+
+
+    def unwatch(self, directory):
+        if self.notifier is None or directory not in self.watched_directories:
+            return
+
+        log.info("No longer watching {0}".format(directory))
+        self.watched_directories.discard(directory)
+
+        # INotify has no way of ignoring a whole tree watched recursively,
+        #  so each watched subdirectory is ignored on its own.
+        for watch in list(self.notifier._watchpoints.values()):
+            watched_path = watch.path.path
+            if watched_path == directory or watched_path.startswith(directory + os.sep):
+                self.notifier.ignore(watch.path)
+
+
+    def notify(self, ignored, path, mask):
+        path = path.path
+        is_directory = bool(mask & inotify.IN_ISDIR)
+        if is_directory and mask & inotify.IN_ATTRIB:
+            # The files in the directory report their own changes.
+            return
+
+        if mask & (inotify.IN_DELETE | inotify.IN_MOVED_FROM):
+            self.changed_paths.discard(path)
+            if is_directory:
+                self.deleted_directories.add(path)
+            else:
+                self.deleted_paths.add(path)
+
+        else:
+            # A created, modified or moved in path. Its size, or whether it
+            #  still exists at all, is looked up when the batch is applied.
+            self.deleted_paths.discard(path)
+            self.deleted_directories.discard(path)
+            self.changed_paths.add(path)
+
+        if self.pending_update is None or not self.pending_update.active():
+            self.pending_update = reactor.callLater(self.batch_delay, self.update_cache)
+
+
+    def update_cache(self):
+        # The changes are applied in a thread, since a directory moved in is
+        #  walked in full. One batch is applied at a time, so that changes
+        #  are applied in the order they were reported. Those reported in
+        #  the meantime are applied once the batch is done.
+        if self.applying_changes:
+            return
+        changed_paths, self.changed_paths = self.changed_paths, set()
+        deleted_paths, self.deleted_paths = self.deleted_paths, set()
+        deleted_directories, self.deleted_directories = self.deleted_directories, set()
+
+        self.applying_changes = True
+        d = threads.deferToThread(
+            self.apply_changes,
+            changed_paths,
+            deleted_paths,
+            deleted_directories
+        )
+        d.addErrback(lambda failure: log.error(
+            "Applying changes to cache failed:\n{0}".format(failure.getTraceback())
+        ))
+        d.addCallback(self.changes_applied)
+
+
+    def changes_applied(self, ignored):
+        self.applying_changes = False
+        has_changes = self.changed_paths or self.deleted_paths or self.deleted_directories
+        if has_changes and (self.pending_update is None or not self.pending_update.active()):
+            self.update_cache()
+
+
+    def apply_changes(self, changed_paths, deleted_paths, deleted_directories):
+        # Called in a thread.
+        for directory in deleted_directories:
+            self.cache.removeDirectory(directory)
+        if deleted_paths:
+            self.cache.removeFiles(list(deleted_paths))
+
+        changed_files = []
+        for path in changed_paths:
+            if os.path.isdir(path):
+                # A directory moved into a content directory already has
+                #  files in it, which would not be reported one by one.
+                self.cache.addDirectory(path)
+            elif os.path.isfile(path):
+                directory, filename = os.path.split(path)
+                try:
+                    status = os.stat(path)
+                    changed_files.append((directory, filename, status.st_size, status.st_dev, status.st_ino))
+                except OSError:
+                    # Deleted again since it was reported.
+                    self.cache.removeFiles([path])
+
+        if changed_files:
+            self.cache.addFiles(changed_files)
+
+        log.debug("Applied {0} changed and {1} deleted paths to cache".format(
+            len(changed_paths), len(deleted_paths) + len(deleted_directories)
+        ))
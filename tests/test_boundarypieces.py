@@ -0,0 +1,113 @@
+import os
+import sys
+import shutil
+import random
+import tempfile
+import unittest
+from hashlib import sha1
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'localbff', 'localbff'))
+import metafile
+from localbff import LocalBitTorrentFileFinder
+
+PIECE_SIZE = 16384
+
+
+def getPieces(payload):
+  return b''.join(
+    sha1(payload[start:start+PIECE_SIZE]).digest()
+    for start in range(0, len(payload), PIECE_SIZE)
+  )
+
+
+def withByteFlipped(data, offset):
+  data = bytearray(data)
+  data[offset] ^= 1
+  return bytes(data)
+
+
+class BoundaryPieceTest(unittest.TestCase):
+  """Near copies of a file that only differ from it in some of its pieces
+  are told apart, without ever blaming the neighbouring files of a boundary
+  piece for a copy that does not match."""
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.random = random.Random(1)
+
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+
+  def makeFile(self, name, data):
+    path = os.path.join(self.directory, name)
+    with open(path, 'wb') as f:
+      f.write(data)
+    return path
+
+
+  def match(self, files, fastVerification):
+    # files holds, for each file of the payload, its name, its data, and
+    #  the data of each of its possible matches.
+    payload = b''.join(data for name, data, copies in files)
+    m = metafile.getMetafileFromDict({'info': {
+      'name': 'payload',
+      'piece length': PIECE_SIZE,
+      'pieces': getPieces(payload),
+      'files': [{'length': len(data), 'path': [name]} for name, data, copies in files],
+    }})
+
+    finder = LocalBitTorrentFileFinder(m, fastVerification=fastVerification)
+    for i, (name, data, copies) in enumerate(files):
+      finder.connectPayloadFileToPotentialMatches(i, [
+        self.makeFile('{0}.{1}'.format(name, j), copy) for j, copy in enumerate(copies)
+      ])
+    finder.positivelyMatchFilesInMetafileToPossibleMatches()
+    return finder
+
+
+  def randomData(self, size):
+    return bytes(bytearray(self.random.getrandbits(8) for i in range(size)))
+
+
+  def test_copyFailingAnInnerPieceIsEliminated(self):
+    # The near copy holds the first piece of a, but not the second.
+    a = self.randomData(40000)
+    b = self.randomData(10000)
+    nearCopy = withByteFlipped(a, 20000)
+    for copies, exactCopy in (([nearCopy, a], 'a.1'), ([a, nearCopy], 'a.0')):
+      finder = self.match([
+        ('a', a, copies),
+        ('b', b, [b]),
+      ], fastVerification=False)
+
+      exactCopy = os.path.join(self.directory, exactCopy)
+      self.assertEqual(finder.files[0].status, "MATCH_FOUND")
+      self.assertEqual(finder.files[0].matchedFilePath, exactCopy)
+      self.assertEqual(finder.files[0].possibleMatches, [exactCopy])
+      self.assertEqual(finder.files[1].matchedFilePath, os.path.join(self.directory, 'b.0'))
+      self.assertAlmostEqual(finder.percentageMatched, 100.0)
+
+
+  def test_onlyCopyOfNeighbourIsNotBlamed(self):
+    # a.0 differs from a in its last byte, which only the piece spanning
+    #  a, c and d holds. c and d have a copy each.
+    a = self.randomData(40000)
+    c = self.randomData(3000)
+    d = self.randomData(40000)
+    for fastVerification in (True, False):
+      finder = self.match([
+        ('a', a, [withByteFlipped(a, len(a)-1), a]),
+        ('c', c, [c]),
+        ('d', d, [d]),
+      ], fastVerification)
+
+      self.assertEqual(
+        [(f.status, f.matchedFilePath) for f in finder.files],
+        [("MATCH_FOUND", os.path.join(self.directory, name + '.' + index)) for name, index in (('a', '1'), ('c', '0'), ('d', '0'))]
+      )
+      self.assertAlmostEqual(finder.percentageMatched, 100.0)
+
+
+if __name__ == '__main__':
+  unittest.main()